@@ -0,0 +1,99 @@
+from .process import start_process, finish_process
+from subprocess import PIPE
+from threading import Lock
+import struct
+import sys
+
+class CommandServerError(Exception):
+    pass
+
+def encode_arg(arg):
+    if isinstance(arg, unicode):
+        return arg.encode(sys.getfilesystemencoding() or 'utf-8')
+    return arg
+
+class CommandServer(object):
+    """
+    Talks to a persistent "hg serve --cmdserver pipe" process, so running a
+    command doesn't pay for Mercurial's startup and extension loading.
+    """
+    def __init__(self, cwd, env, hg='hg', new_group=False):
+        self.cwd = cwd
+        self.lock = Lock()
+        self.process = start_process([hg, 'serve', '--cmdserver', 'pipe'], new_group,
+                                     cwd=cwd, env=env, stdin=PIPE, stdout=PIPE)
+        try:
+            channel, data = self._read_channel()
+        except CommandServerError:
+            self.close()
+            raise
+        capabilities = ()
+        for line in data.split('\n'):
+            if line.startswith('capabilities:'):
+                capabilities = line.split(':', 1)[1].split()
+        if channel != 'o' or 'runcommand' not in capabilities:
+            self.close()
+            raise CommandServerError('Unsupported command server in %s' % cwd)
+
+    def _read_channel(self):
+        header = self.process.stdout.read(5)
+        if len(header) < 5:
+            raise CommandServerError('Command server in %s terminated unexpectedly'
+                                     % self.cwd)
+        channel, length = struct.unpack('>cI', header)
+        if channel in 'IL':
+            # Input requests only announce the maximum size they accept
+            return channel, length
+        return channel, self.process.stdout.read(length)
+
+    def _write_block(self, data):
+        self.process.stdin.write(struct.pack('>I', len(data)) + data)
+        self.process.stdin.flush()
+
+    def runcommand(self, args, output=None):
+        """
+        Returns the exit status and the combined stdout/stderr output. If
+        output (a file-like object) is given the output is written to it and
+        returned instead of a string.
+        """
+        sink = output if output is not None else []
+        write = sink.write if output is not None else sink.append
+        with self.lock:
+            try:
+                self.process.stdin.write('runcommand\n')
+                self._write_block('\0'.join(map(encode_arg, args)))
+                while True:
+                    channel, data = self._read_channel()
+                    if channel in 'oe':
+                        write(data)
+                    elif channel == 'r':
+                        if output is None:
+                            output = ''.join(sink)
+                        return struct.unpack('>i', data)[0], output
+                    elif channel in 'IL':
+                        # Just like with NOPROMPT, stdin is never available
+                        self._write_block('')
+                    elif channel.isupper():
+                        raise CommandServerError('Unsupported required channel %s'
+                                                 % channel)
+            except (IOError, OSError) as error:
+                raise CommandServerError('Command server in %s failed: %s'
+                                         % (self.cwd, error))
+
+    def close_if_idle(self):
+        # Returns whether the server was closed
+        if not self.lock.acquire(False):
+            return False
+        try:
+            self.close()
+        finally:
+            self.lock.release()
+        return True
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+        finish_process(self.process)
@@ -1,20 +1,73 @@
-from .repo import get_local_repo, get_remote_repo, ProcessError, DEFAULT_BRANCH
-from .utils import AsyncResult, with_lock, get_secure_random_string
-from ConfigParser import RawConfigParser
+from __future__ import print_function
+from .repo import (get_local_repo, get_remote_repo, get_source_host, ProcessError,
+    DEFAULT_BRANCH, enable_hg_cmdserver, close_hg_servers,
+    close_idle_hg_servers, set_ssh_command)
+from .dateindex import DateIndex, parse_date
+from .depscache import read_deps, load_deps_cache, save_deps_cache
+from .manifest import Manifest
+from .mirror import enable_mirrors
+from .process import (with_action, set_timeouts, kill_running_processes,
+    wait_for_killed_processes, KILL_GRACE_PERIOD)
+from .spool import SpooledOutput, set_spool_threshold
+from .sshmux import SSHMultiplexer
+from .trace import enable_trace, write_trace, span, traced
+from .utils import (get_executor, set_jobs, get_secure_random_string, as_completed,
+    positive_int,
+    ProgressLine)
+from ConfigParser import Error as ConfigParserError, RawConfigParser
+from cStringIO import StringIO
 from datetime import datetime
-from subprocess import call
-from threading import Semaphore
+from subprocess import call, Popen, PIPE
 from urllib2 import urlopen
+import errno
 import json
 import os
 import platform
 import sys
+import time
 
 # TODO: replace sys.exit() with exceptions
 
+def create_links(root, links):
+    """
+    Creates the given links and returns warnings about the links which
+    couldn't be created because a file or folder is in the way.
+    """
+    warnings = []
+    created = []
+    # Each link is created under a temporary name and then renamed, so the
+    # link path never exists in a half-finished state
+    for link_name, target in sorted(links.items()):
+        path = os.path.join(root, link_name)
+        # Only old links get replaced, never the user's files or folders
+        if os.path.lexists(path) and not os.path.islink(path):
+            warnings.append('\nWarning: The link %s could not be created because '
+                            'a file or folder with that name already exists.\n'
+                            % link_name)
+            continue
+        get_or_mkdir(os.path.dirname(path))
+        temp_path = '%s.dm-%s' % (path, get_secure_random_string(8))
+        os.symlink(target, temp_path)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            os.remove(temp_path)
+            raise
+        created.append(link_name)
+    if created:
+        names = created[:]
+        if len(names) > 5:
+            names[5:] = ['and %d more' % (len(names) - 5)]
+        print('Created %d link%s: %s' % (len(created), '' if len(created) == 1 else 's',
+                                         ', '.join(names)))
+    return warnings
+
 def batch_create_links(root, links):
+    # Returns warnings about links which couldn't be created
     if not links:
-        return
+        return []
+    if platform.system() != 'Windows':
+        return create_links(root, links)
     script = os.path.join(os.path.dirname(os.path.dirname(__file__)),
                           'utilscripts', 'batch-create-links.py')
     params = []
@@ -24,6 +77,7 @@ def batch_create_links(root, links):
         params.append(path)
         params.append(target)
     call([sys.executable, script] + params)
+    return []
 
 def remove_link(path):
     if os.path.isdir(path) and os.path.islink(path) and platform.system() == 'Windows':
@@ -32,7 +86,8 @@ def remove_link(path):
         os.remove(path)
 
 def get_mapped_branches(project):
-    return mapped_branches(*project.branches())
+    snapshot = project.snapshot(('active_branch', 'branches'))
+    return mapped_branches(snapshot['active_branch'], snapshot['branches'])
 
 def mapped_branches(active_branch, branches):
     if active_branch is None:
@@ -66,26 +121,31 @@ def _normalize_link(repo_name, target):
         return repo_name + target[1:]
     return target
 
+def parse_links(repo_name, items):
+    package_name = repo_name.rsplit('-', 1)[-1]
+    return {name.replace('@', package_name):
+                _normalize_link(repo_name, target).replace('@', package_name)
+            for name, target in items}
+
 def load_repo_config(root):
-    config = RawConfigParser()
-    config.read(os.path.join(root, '.deps'))
+    config = read_deps(os.path.join(root, '.deps'))
     repo_name = os.path.basename(root)
-    package_name = repo_name.rsplit('-', 1)[-1]
-    repos = config.items('repos') if config.has_section('repos') else ()
+    repos = config.get('repos', ())
 
-    links = {name.replace('@', package_name):
-                _normalize_link(repo_name, target).replace('@', package_name)
-             for name, target in (config.items('links')
-                                  if config.has_section('links') else ())}
+    links = parse_links(repo_name, config.get('links', ()))
 
     dependencies = []
-    if config.has_option('general', 'dependencies'):
-        dependencies = config.get('general', 'dependencies').split()
+    general = dict(config.get('general', ()))
+    if 'dependencies' in general:
+        dependencies = general['dependencies'].split()
     repos = dict(repos)
     for name, path in repos.items():
         if not '://' in path and not path.startswith('['):
             repos[name] = os.path.abspath(path)
-    return {'repos': repos, 'links': links, 'dependencies': dependencies}
+    # Network operations get throttled per remote host
+    hosts = {name: get_source_host(source) for name, source in repos.items()}
+    return {'repos': repos, 'links': links, 'dependencies': dependencies,
+            'hosts': hosts}
 
 def get_or_mkdir(path):
     if path and not os.path.exists(path):
@@ -101,8 +161,8 @@ def get_backups_root(root):
 def get_dependencies_root(root):
     return os.path.join(root, '.repos')
 
-def collect_links(base_root):
-    for root, dirs, files in os.walk(base_root, followlinks=True):
+def collect_links(base_root, start=None):
+    for root, dirs, files in os.walk(start or base_root, followlinks=True):
         for name in dirs[:]:
             path = os.path.join(root, name)
             if os.path.islink(path):
@@ -115,7 +175,25 @@ def collect_links(base_root):
             if os.path.islink(path):
                 yield path[len(base_root) + 1:].replace('\\', '/')
 
-def get_loaded_dependencies(root):
+def scan_links(root):
+    # Searches the top-level directories in parallel
+    def collect(path):
+        return list(collect_links(root, path))
+    names = []
+    tasks = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if os.path.islink(path):
+            names.append(name)
+        elif os.path.isdir(path) and name not in ('.hg', '.git', '.svn', '.repos'):
+            tasks.append(get_executor().submit(collect, (path,)))
+    for task in tasks:
+        names.extend(task.do())
+    return names
+
+def get_loaded_dependencies(root, manifest=None, rescan=False):
+    if manifest is None:
+        manifest = Manifest.load(root)
     deps_root = get_dependencies_root(root)
     dependencies = {}
     dependencies['repos'] = repos = {}
@@ -128,11 +206,16 @@ def get_loaded_dependencies(root):
             repo = get_local_repo(path)
             if repo is None:
                 raise ValueError('No repo "%s" found at path %s' % (name, path))
-            repos[name] = repo.get_source()
+            repos[name] = manifest.get_source(name, repo)
 
     dependencies['links'] = links = {}
     deps_base = os.path.abspath(os.path.basename(deps_root)).replace('\\', '/') + '/'
-    for name in collect_links(root):
+    if rescan or not manifest.deps:
+        link_names = scan_links(root)
+    else:
+        # Only the links created by dm and their directories have to be checked
+        link_names = manifest.find_links()
+    for name in link_names:
         path = os.path.join(root, name)
         path = os.path.abspath(os.path.join(os.path.dirname(path), os.readlink(path)))
         path = path.replace('\\', '/')
@@ -141,15 +224,47 @@ def get_loaded_dependencies(root):
         links[name] = path[len(deps_base):]
     return dependencies
 
-def clone_repo(root, source, destination, revision=None, date=None, branch=None):
+def get_clone_sparse_paths(local_repo, name, project_links):
+    # The clone doesn't have a working copy, yet, so the package's links come
+    # from the committed .deps file. If the clone gets updated to a different
+    # revision its links get fixed by the build, so this is just a best guess.
+    to_link = [(link_name, target) for link_name, target in project_links.items()
+               if target.split('/', 1)[0] == name]
+    content = local_repo.get_checkout_file('.deps')
+    if content:
+        config = RawConfigParser()
+        try:
+            config.readfp(StringIO(content))
+        except ConfigParserError:
+            return None
+        if config.has_section('links'):
+            to_link += [(link_name, target) for link_name, target
+                        in parse_links(name, config.items('links')).items()
+                        if link_name not in project_links and
+                        (target == name or target.startswith(name + '/'))]
+    return get_sparse_paths(name, to_link)
+
+def clone_repo(root, source, destination, revision=None, date=None, branch=None,
+               sparse_links=None):
     destination = os.path.abspath(destination)
     get_or_mkdir(os.path.dirname(destination))
     if root and try_restore_from_backups(root, os.path.basename(destination), source):
         local_repo = get_local_repo(destination)
         output = 'Restored from backup\n' + local_repo.pull()
+        needs_checkout = False
     else:
-        output = get_remote_repo(source).clone(destination)
+        # Clone without a working copy, so only the final target gets checked out
+        clone_options = get_clone_options(os.path.basename(destination))
+        output = get_remote_repo(source).clone(destination, checkout=False,
+                                               **clone_options)
+        needs_checkout = True
     local_repo = get_local_repo(destination)
+    if needs_checkout and sparse_links is not None:
+        # Narrow the working copy before anything gets checked out
+        paths = get_clone_sparse_paths(local_repo, os.path.basename(destination),
+                                       sparse_links)
+        if paths:
+            output += local_repo.sparse_checkout(paths)
     if date:
         assert not revision
         assert not branch
@@ -158,17 +273,22 @@ def clone_repo(root, source, destination, revision=None, date=None, branch=None)
         if active_branch != branch:
             if branch in branches:
                 output += local_repo.update(branch)
-                if revision and revision != branch:
-                    output += local_repo.merge(revision)
-            else:
-                if revision and active_branch != revision:
-                    if revision in branches:
-                        output += local_repo.update(revision)
-                    elif active_branch != DEFAULT_BRANCH:
-                        output += local_repo.update(DEFAULT_BRANCH)
-                output += local_repo.create_branch(branch)
+                needs_checkout = False
+            elif revision and active_branch != revision:
+                if revision in branches:
+                    output += local_repo.update(revision)
+                    needs_checkout = False
+                elif active_branch != DEFAULT_BRANCH:
+                    output += local_repo.update(DEFAULT_BRANCH)
+                    needs_checkout = False
+        if needs_checkout:
+            output += local_repo.checkout()
+        if branch not in branches:
+            output += local_repo.create_branch(branch)
         elif revision and revision != branch:
             output += local_repo.merge(revision)
+    elif needs_checkout and not revision and not date:
+        output += local_repo.checkout()
     else:
         output += local_repo.update(revision=revision, date=date)
     return 'Cloning %s\n%s' % (source, output)
@@ -206,7 +326,31 @@ def filter_repos_by_name(repos, repo_names):
     names = {get_humane_repo_name(repos, name) for name in repo_names}
     return {name: repos[name] for name in names}
 
-def run_in_all_repos(action, parallel=True, max_parallel=None, repo_names=None,
+# Command-wide options which get set up by configure()
+options = {
+    # Print each repo's result as soon as it's finished instead of sorted by name
+    'stream': False,
+    # Print a sorted summary after streamed results
+    'summary': False,
+    # Show the results of run_in_all_repos in a pager
+    'pager': False,
+    # Clone options (depth, filter) by repo name, with None for all repos
+    'clone': {},
+    # Only check out the linked paths of dependencies
+    'sparse_checkout': False,
+}
+
+CLONE_OPTIONS = {'depth': int, 'filter': str}
+
+def get_clone_options(name):
+    clone_options = dict(options['clone'].get(None, {}))
+    clone_options.update(options['clone'].get(name, {}))
+    return clone_options
+
+# Actions which talk to the remote repository
+NETWORK_ACTIONS = {'pull', 'fetch', 'push', 'incoming', 'outgoing', 'delete_branch'}
+
+def run_in_all_repos(action, parallel=True, repo_names=None,
                      kwargs=None, project_kwargs=None, skip_project=False):
     if kwargs is None:
         kwargs = {}
@@ -214,7 +358,8 @@ def run_in_all_repos(action, parallel=True, max_parallel=None, repo_names=None,
         project_kwargs = {}
     project_kwargs = dict(kwargs, **project_kwargs)
 
-    repos = collect_repos()
+    root = get_project_root()
+    repos = collect_repos(root)
     if repo_names is not None:
         repos = filter_repos_by_name(repos, repo_names)
 
@@ -231,32 +376,137 @@ def run_in_all_repos(action, parallel=True, max_parallel=None, repo_names=None,
             getattr(repos[name], action)(**kw)
         return
 
+    hosts = {}
+    if action in NETWORK_ACTIONS:
+        hosts = load_repo_config(root)['hosts']
+        if '<project>' in repos:
+            hosts['<project>'] = get_source_host(repos['<project>'].get_source())
+
     threads = {}
-    if max_parallel >= 1:
-        lock = Semaphore(max_parallel)
+    executor = get_executor()
     for name in repos:
-        func = getattr(repos[name], action)
-        if max_parallel >= 1:
-            func = with_lock(func, lock)
         kw = project_kwargs if name == '<project>' else kwargs
-        threads[name] = AsyncResult(func, kwargs=kw)
+        func = with_action(getattr(repos[name], action), action)
+        threads[name] = executor.submit(traced(func, action, 'repo', repo=name),
+                                        kwargs=kw, group=hosts.get(name))
 
-    errors = []
-    for name in sorted(threads):
-        result = threads[name].do()
-        if isinstance(result, ProcessError):
-            errors.append(name)
-        if result and (not isinstance(result, basestring) or result.strip()):
-            print('%s: %s' % (action.replace('_', ' ').capitalize(), name))
-            print(result)
+    pager = open_pager()
+    stream = pager.stdin if pager is not None else sys.stdout
+    try:
+        if options['stream']:
+            errors = stream_results(action, threads, stream,
+                                    show_progress=pager is None and sys.stdout.isatty())
+        else:
+            errors = []
+            for name in sorted(threads):
+                result = threads[name].do()
+                if isinstance(result, ProcessError):
+                    errors.append(name)
+                print_result(action, name, result, stream)
+    except IOError as error:
+        # The pager got closed before all results were shown
+        if pager is None or error.errno != errno.EPIPE:
+            raise
+        errors = [name for name, task in threads.items()
+                  if isinstance(task.do(), ProcessError)]
+    except KeyboardInterrupt:
+        unfinished = sorted(name for name, task in threads.items() if not task.done())
+        cancel_running_tasks()
+        sys.stderr.write('\nInterrupted. The following repos did not finish: %s\n'
+                         % ', '.join(unfinished))
+        sys.exit(1)
+    finally:
+        if pager is not None:
+            try:
+                pager.stdin.close()
+            except IOError:
+                pass
+            pager.wait()
 
     if errors:
         sys.stderr.write('\n'
                          'Errors happened for the following repos: %s\n'
                          'Scroll upwards to see the errors. ;)\n'
-                         % ', '.join(errors))
+                         % ', '.join(sorted(errors)))
         sys.exit(1)
 
+def cancel_running_tasks():
+    get_executor().cancel()
+    # Idle command servers exit cleanly when closed, so they don't get killed
+    close_idle_hg_servers()
+    kill_running_processes()
+
+def get_action_name(func):
+    # E.g., pull_repo => pull
+    return func.__name__.rsplit('_repo', 1)[0]
+
+def open_pager():
+    if not options['pager'] or not sys.stdout.isatty():
+        return None
+    return Popen(os.environ.get('PAGER') or 'less -FRX', shell=True, stdin=PIPE)
+
+def has_output(result):
+    return result and (not isinstance(result, basestring) or result.strip())
+
+def print_result(action, name, result, stream=None):
+    if stream is None:
+        stream = sys.stdout
+    if not has_output(result):
+        return
+    print('%s: %s' % (action.replace('_', ' ').capitalize(), name), file=stream)
+    if isinstance(result, SpooledOutput):
+        # Stream the output instead of loading it into memory
+        result.write_to(stream)
+        result.close()
+        print(file=stream)
+    else:
+        print(result, file=stream)
+
+def stream_results(action, threads, stream, show_progress=False):
+    names = {task: name for name, task in threads.items()}
+    progress = None
+    if show_progress:
+        progress = ProgressLine(sys.stdout)
+
+    def update_progress():
+        now = time.time()
+        running = sorted((task.started, names[task]) for task in threads.values()
+                         if task.started is not None and not task.done())
+        slowest = ', '.join('%s (%ds)' % (name, now - started)
+                            for started, name in running[:3])
+        progress.show('[%d/%d done] %s' % (done, len(threads),
+                                           'waiting for: ' + slowest if slowest else ''))
+
+    errors = []
+    results = {}
+    done = 0
+    for task in as_completed(threads.values(),
+                             on_wait=update_progress if progress else None):
+        done += 1
+        name = names[task]
+        result = task.do()
+        if isinstance(result, ProcessError):
+            errors.append(name)
+        if progress is not None:
+            progress.clear()
+        # Only remember the state because the output might be large
+        if isinstance(result, ProcessError):
+            results[name] = 'failed'
+        elif has_output(result):
+            results[name] = 'done'
+        else:
+            results[name] = 'nothing to report'
+        print_result(action, name, result, stream)
+        stream.flush()
+    if progress is not None:
+        progress.clear()
+
+    if options['summary']:
+        print('Summary:', file=stream)
+        for name in sorted(results):
+            print('  %s: %s' % (name, results[name]), file=stream)
+    return errors
+
 def fetch_repo(name, root):
     if name is None:
         name = '<project>'
@@ -275,11 +525,11 @@ def pull_repo(name, root):
         return 'Pulling %s\n%s' % (name, result)
     return ''
 
-def update_repo(name, root, revision=None, date=None):
+def update_repo(name, root, revision=None, date=None, resolved=None):
     if name is None:
         name = '<project>'
     repo = get_local_repo(root)
-    result = repo.update(revision=revision, date=date)
+    result = repo.update(revision=revision, date=date, resolved=resolved)
     if result and result.strip():
         return 'Updating %s\n%s' % (name, result)
     return ''
@@ -333,12 +583,75 @@ def try_restore_from_backups(root, name, source=None):
             return True
     return False
 
+def get_dependency_links(name, destination, config):
+    subconfig = load_repo_config(destination)
+
+    # Check config
+    if subconfig['repos']:
+        sys.stderr.write('Error: The .deps file in %s has its own repo '
+                         'dependencies. This is very inefficient and thus '
+                         'disallowed.\n' % name)
+        sys.exit(1)
+
+    for subdependency in subconfig['dependencies']:
+        if subdependency not in config['repos']:
+            sys.stderr.write('Error: The .deps file in %s has a dependency to '
+                             '%s which is not listed in the project .deps.\n'
+                             % (name, subdependency))
+            sys.exit(1)
+
+    # Check conflicts in link definitions
+    for subname, subtarget in subconfig['links'].items():
+        if subtarget != name and not subtarget.startswith(name + '/'):
+            sys.stderr.write('Error: The .deps file in %s defines a '
+                             'link %s pointing to %s which is not part '
+                             'of that repository.\n'
+                             % (name, subname, subtarget))
+            sys.exit(1)
+    return list(subconfig['links'].items())
+
+def get_sparse_paths(name, to_link):
+    # Only the .deps file and the linked paths of a repo are needed. Returns
+    # None if the whole repo is needed.
+    if not to_link:
+        return None
+    paths = {'.deps'}
+    for link_name, target in to_link:
+        if target == name:
+            return None
+        paths.add(target[len(name) + 1:])
+    return sorted(paths)
+
+def update_links(root, to_link, existing_links, links):
+    """
+    Records the given links in links and returns the links which have to be
+    (re)created, mapping their names to their relative targets.
+    """
+    new_links = {}
+    for name, target in to_link:
+        links[name] = target
+        if target == existing_links.get(name):
+            continue
+        link_path = os.path.join(root, name)
+        if os.path.exists(link_path) and os.path.islink(link_path):
+            remove_link(link_path)
+        new_links[name] = os.path.relpath(os.path.join(root, '.repos', target),
+                                          os.path.dirname(link_path))
+    return new_links
+
 def build_project(root, preload=None, revision=None, active_branch=None, branches=None,
-                  **kwargs):
+                  rescan=False, resolved=None, **kwargs):
     has_revision = revision is not None
     if not has_revision:
         revision = {}
 
+    manifest = Manifest.load(root)
+    settings = {'sparse_checkout': options['sparse_checkout']}
+    if preload is None and not has_revision and not rescan:
+        with span('check manifest', 'build'):
+            if manifest.is_up_to_date(settings):
+                return
+
     if branches is None:
         branches = get_mapped_branches(get_local_repo(root))[1]
 
@@ -351,29 +664,77 @@ def build_project(root, preload=None, revision=None, active_branch=None, branche
                 rev = (branches[revision] if revision == 'master'
                        else '%s___%s' % (revision, branches[revision]))
             kw['revision'] = rev
-        print(preload(None, root, **kw))
+        if resolved:
+            kw['resolved'] = resolved.get('.')
+        action = get_action_name(preload)
+        with span(action, 'build', repo='<project>'):
+            print(with_action(preload, action)(None, root, **kw))
 
     # Set active branch after preload call because preload might switch branches
     if active_branch is None:
         active_branch = get_mapped_branches(get_local_repo(root))[0]
 
     deps_root = get_dependencies_root(root)
-    loaded_dependencies = get_loaded_dependencies(root)
+    with span('find links', 'build', rescan=rescan):
+        loaded_dependencies = get_loaded_dependencies(root, manifest, rescan)
     loaded_repos = loaded_dependencies['repos']
     existing_links = loaded_dependencies['links']
     unprocessed_repos = set(loaded_repos.keys())
     unprocessed_links = set(existing_links.keys())
-    config = load_repo_config(root)
+    with span('load config', 'build'):
+        config = load_repo_config(root)
 
     warnings = []
+    failed_repos = []
+    links = {}
+    new_links = {}
+    sparse_repos = set()
+    # Clones which might have been narrowed before their first checkout
+    sparse_clones = set()
+    # Links defined by the project get created as soon as their repo exists
+    project_links = {}
+    for name, target in config['links'].items():
+        project_links.setdefault(target.split('/', 1)[0], []).append((name, target))
+
+    def link_dependency(name, destination):
+        with span('validate config', 'build', repo=name):
+            # The project's links take precedence over the packages' links
+            to_link = [(link_name, target) for link_name, target
+                       in get_dependency_links(name, destination, config)
+                       if link_name not in config['links']]
+            to_link += project_links.pop(name, [])
+        paths = None
+        if options['sparse_checkout']:
+            paths = get_sparse_paths(name, to_link)
+        if paths:
+            sparse_repos.add(name)
+        # Only working copies narrowed by dm get restored, so the user's own
+        # sparse configuration is left alone
+        repo = get_local_repo(destination)
+        if repo is not None and (paths or name in manifest.sparse or
+                                 name in sparse_clones):
+            with span('sparse checkout', 'build', repo=name):
+                try:
+                    output = repo.sparse_checkout(paths)
+                except ProcessError as error:
+                    output = 'Warning: Sparse checkout failed for %s:\n%s' % (name, error)
+            if output.strip():
+                print(output)
+        with span('links', 'build', repo=name):
+            created = update_links(root, to_link, existing_links, links)
+            # On Windows symlinks require admin permission and we only want to
+            # ask the user for permission once, so they're batch-created later
+            if platform.system() == 'Windows':
+                new_links.update(created)
+            else:
+                warnings.extend(batch_create_links(root, created))
+
     try:
-        to_load = sorted(config['repos'].items(), key=lambda x: x[0])
-        to_link = list(config['links'].items())
-        post_load = []
-        if to_load:
+        if config['repos']:
             get_or_mkdir(deps_root)
-        while to_load:
-            name, source = to_load.pop()
+        ready = []
+        tasks = {}
+        for name, source in sorted(config['repos'].items()):
             destination = os.path.normpath(os.path.join(deps_root, name))
             rev = None
             if has_revision:
@@ -386,58 +747,52 @@ def build_project(root, preload=None, revision=None, active_branch=None, branche
                                     'changed. Your existing repository has been '
                                     'moved to\n%s\n' % (name, backup_dir))
                 kw = kwargs
-                if not has_revision or not isinstance(revision, dict):
+                if kwargs.get('date'):
+                    # The new clone resolves the date itself since the date
+                    # index doesn't know it, yet. Like in update() the date
+                    # wins over the revision.
+                    rev = None
+                elif not has_revision or not isinstance(revision, dict):
                     kw = dict(kwargs, branch=branches[active_branch])
-                thread = AsyncResult(clone_repo, (root, source, destination, rev), kw)
-                post_load.insert(0, (name, source, destination, thread))
+                if options['sparse_checkout']:
+                    kw = dict(kw, sparse_links=config['links'])
+                    sparse_clones.add(name)
+                func = traced(with_action(clone_repo, 'clone'), 'clone', 'build',
+                              repo=name)
+                thread = get_executor().submit(func, (root, source, destination, rev), kw,
+                                               group=config['hosts'][name])
+                tasks[thread] = (name, destination)
             elif preload is not None:
                 kw = kwargs.copy()
                 if has_revision:
                     kw['revision'] = rev
-                thread = AsyncResult(preload, (name, destination), kw)
-                post_load.insert(0, (name, source, destination, thread))
+                if resolved:
+                    kw['resolved'] = resolved.get(name)
+                action = get_action_name(preload)
+                func = traced(with_action(preload, action), action, 'build', repo=name)
+                # Only network operations count against the host's limit
+                group = config['hosts'][name] if action in NETWORK_ACTIONS else None
+                thread = get_executor().submit(func, (name, destination), kw,
+                                               group=group)
+                tasks[thread] = (name, destination)
             else:
-                post_load.insert(0, (name, source, destination, None))
-
-        post_load = list(reversed(post_load))
-        while post_load:
-            name, source, destination, thread = post_load.pop()
-            if thread is not None:
-                result = thread.do()
-                if isinstance(result, ProcessError):
-                    warnings.append('Error while processing %s:\n%s\n'
-                                    % (name, str(result)))
-                elif result and result.strip():
-                    print(result)
-
-            if name in unprocessed_repos:
-                unprocessed_repos.remove(name)
-
-            subconfig = load_repo_config(destination)
-
-            # Check config
-            if subconfig['repos']:
-                sys.stderr.write('Error: The .deps file in %s has its own repo '
-                                 'dependencies. This is very inefficient and thus '
-                                 'disallowed.\n' % name)
-                sys.exit(1)
-
-            for subdependency in subconfig['dependencies']:
-                if subdependency not in config['repos']:
-                    sys.stderr.write('Error: The .deps file in %s has a dependency to '
-                                     '%s which is not listed in the project .deps.\n'
-                                     % (name, subdependency))
-                    sys.exit(1)
-
-            # Check conflicts in link definitions
-            for subname, subtarget in subconfig['links'].items():
-                if subtarget != name and not subtarget.startswith(name + '/'):
-                    sys.stderr.write('Error: The .deps file in %s defines a '
-                                     'link %s pointing to %s which is not part '
-                                     'of that repository.\n'
-                                     % (name, subname, subtarget))
-                    sys.exit(1)
-                to_link.append((subname, subtarget))
+                ready.append((name, destination))
+            unprocessed_repos.discard(name)
+
+        # Repos which don't have to be cloned or preloaded can be linked
+        # immediately while the others get linked in the order they finish
+        for name, destination in ready:
+            link_dependency(name, destination)
+        for thread in as_completed(list(tasks)):
+            name, destination = tasks[thread]
+            result = thread.do()
+            if isinstance(result, ProcessError):
+                # Errors are reported right away and summarized at the end
+                failed_repos.append(name)
+                sys.stderr.write('Error while processing %s:\n%s\n' % (name, str(result)))
+            elif result and result.strip():
+                print(result)
+            link_dependency(name, destination)
 
         for name in unprocessed_repos:
             backup_dir = move_to_backups(root, name)
@@ -445,30 +800,122 @@ def build_project(root, preload=None, revision=None, active_branch=None, branche
                             'dependency, anymore. Your existing repository '
                             'has been moved to\n%s\n' % (name, backup_dir))
 
-        new_links = {}
-        while to_link:
-            name, target = to_link.pop()
+        with span('links', 'build'):
+            # Project links pointing into repos which aren't dependencies
+            for to_link in project_links.values():
+                new_links.update(update_links(root, to_link, existing_links, links))
 
-            if target != existing_links.get(name):
-                link_path = os.path.join(root, name)
-                if os.path.exists(link_path) and os.path.islink(link_path):
-                    remove_link(link_path)
-                relative_target = os.path.relpath(os.path.join(root, '.repos', target),
-                                                  os.path.dirname(link_path))
-                new_links[name] = relative_target
+            for name in unprocessed_links:
+                if name not in links:
+                    remove_link(os.path.join(root, name))
 
-            if name in unprocessed_links:
-                unprocessed_links.remove(name)
+            warnings.extend(batch_create_links(root, new_links))
 
-        for name in unprocessed_links:
-            remove_link(os.path.join(root, name))
-
-        # We batch-create multiple links because on Windows symlinks require
-        # admin permission and we only want to ask the user for permission once
-        batch_create_links(root, new_links)
+        # Failed repos have to be processed again by the next build
+        if not failed_repos:
+            manifest.update(config['repos'], links, settings, sparse_repos)
+            manifest.save()
     finally:
         if warnings:
             sys.stderr.write('\n'.join(warnings))
+        if failed_repos:
+            sys.stderr.write('\nErrors happened for the following repos: %s\n'
+                             % ', '.join(sorted(failed_repos)))
+
+def load_settings(root=None):
+    # User-wide settings in ~/.dmrc can be overridden by the project's .dmrc
+    config = RawConfigParser()
+    paths = [os.path.join(os.path.expanduser('~'), '.dmrc')]
+    if root:
+        paths.append(os.path.join(root, '.dmrc'))
+    config.read(paths)
+    return config
+
+def get_setting(settings, name, default=None, section='options', type=None):
+    if not settings.has_option(section, name):
+        return default
+    if type is bool:
+        return settings.getboolean(section, name)
+    if type is not None:
+        return type(settings.get(section, name))
+    return settings.get(section, name)
+
+ssh_multiplexer = None
+
+def configure(args):
+    global ssh_multiplexer
+    if args.trace:
+        enable_trace(args.trace, ' '.join(['dm'] + sys.argv[1:]))
+    try:
+        root = get_project_root()
+    except ValueError:
+        root = None
+    settings = load_settings(root)
+    options['stream'] = args.stream or get_setting(settings, 'stream', False, type=bool)
+    options['summary'] = args.summary or get_setting(settings, 'summary', False,
+                                                     type=bool)
+    options['pager'] = args.pager or get_setting(settings, 'pager', False, type=bool)
+    set_spool_threshold(get_setting(settings, 'spool_threshold', 1024 * 1024, type=int))
+    clone_options = {}
+    if settings.has_section('clone'):
+        # E.g., "depth = 1" for all repos or "docutils.depth = 100" for one repo
+        for key, value in settings.items('clone'):
+            name, _, option = key.rpartition('.')
+            if option not in CLONE_OPTIONS:
+                sys.stderr.write('Warning: Ignoring unknown clone option %s\n' % key)
+                continue
+            clone_options.setdefault(name or None, {})[option] = \
+                CLONE_OPTIONS[option](value)
+    options['clone'] = clone_options
+    options['sparse_checkout'] = get_setting(settings, 'sparse_checkout', False,
+                                             type=bool)
+    if get_setting(settings, 'deps_cache', False, type=bool):
+        load_deps_cache()
+    if get_setting(settings, 'mirror_cache', False, type=bool):
+        mirror_root = get_setting(settings, 'mirror_root')
+        enable_mirrors(mirror_root and os.path.expanduser(mirror_root))
+    timeouts = {}
+    if settings.has_section('timeouts'):
+        timeouts = {action: float(timeout)
+                    for action, timeout in settings.items('timeouts')}
+    if args.timeout:
+        timeouts['default'] = args.timeout
+    set_timeouts(timeouts)
+    host_limits = {}
+    try:
+        if settings.has_section('hosts'):
+            host_limits = {host.lower(): positive_int(limit)
+                           for host, limit in settings.items('hosts')}
+        jobs = args.jobs or get_setting(settings, 'jobs', type=positive_int)
+        max_per_host = args.max_per_host or \
+            get_setting(settings, 'max_per_host', 8, type=positive_int)
+    except ValueError as error:
+        sys.stderr.write('Error: Invalid job limit in .dmrc: %s\n' % error)
+        sys.exit(1)
+    set_jobs(jobs, max_per_host, host_limits)
+    enable_hg_cmdserver(args.hg_cmdserver or
+                        get_setting(settings, 'hg_cmdserver', False, type=bool))
+    # ControlMaster isn't supported by ssh on Windows
+    if (args.ssh_multiplex or get_setting(settings, 'ssh_multiplex', False, type=bool)) \
+            and platform.system() != 'Windows':
+        ssh_multiplexer = SSHMultiplexer()
+        set_ssh_command(
+            ssh_multiplexer.get_ssh_command(os.environ.get('GIT_SSH_COMMAND', 'ssh')),
+            ssh_multiplexer.get_ssh_command())
+
+def shutdown():
+    global ssh_multiplexer
+    cancel_running_tasks()
+    wait_for_killed_processes()
+    # Reaps the killed command servers
+    close_hg_servers()
+    # The tasks' processes are gone, so the workers should stop right away
+    get_executor().shutdown(timeout=KILL_GRACE_PERIOD)
+    if ssh_multiplexer is not None:
+        ssh_multiplexer.close()
+        ssh_multiplexer = None
+    save_deps_cache()
+    write_trace()
 
 def load_revisions(root, only_committed=False):
     config = RawConfigParser()
@@ -481,12 +928,80 @@ def load_revisions(root, only_committed=False):
     repos = collect_repos()
     revisions = {}
 
-    repo_url = repos['.'].get_source()
+    fields = ('revision',) if only_committed else ('revision', 'dirty')
+    tasks = {}
     for name, repo in repos.items():
-        revisions[name] = repo.get_revision(no_uncommitted=not only_committed)
+        repo_fields = fields + ('source',) if name == '.' else fields
+        tasks[name] = get_executor().submit(
+            traced(repo.snapshot, 'snapshot', 'repo', repo=name), (repo_fields,))
+    # Check the results in the same order as before, so the same error wins
+    for name in repos:
+        snapshot = tasks[name].do()
+        if isinstance(snapshot, ProcessError):
+            raise snapshot
+        if snapshot.get('dirty'):
+            raise ValueError('Repository has uncommitted changes: %s' % repos[name].root)
+        revisions[name] = snapshot['revision']
+    repo_url = tasks['.'].do()['source']
 
     return deploy_url, repo_url, revisions
 
+def refresh_date_index(root, names=None):
+    """
+    Updates the date index entries of the given repos (by default the repos
+    which are already indexed) and saves the index if anything changed.
+    """
+    index = DateIndex.load(root)
+    if names is None:
+        names = list(index.repos)
+        if not names:
+            return index
+    repos = collect_repos(root)
+    changed = False
+    for name in list(index.repos):
+        if name not in repos:
+            del index.repos[name]
+            changed = True
+    tasks = {}
+    for name in names:
+        if name not in repos:
+            continue
+        repo = repos[name]
+        func = traced(repo.get_commit_dates, 'index dates', 'repo', repo=name)
+        tasks[name] = get_executor().submit(func, (index.repos.get(name),))
+    for name, task in tasks.items():
+        entry = task.do()
+        # Repos without an entry let the VCS resolve the date
+        if isinstance(entry, ProcessError):
+            entry = None
+        if entry != index.repos.get(name):
+            changed = True
+            if entry is None:
+                del index.repos[name]
+            else:
+                index.repos[name] = entry
+    if changed:
+        index.save()
+    return index
+
+def resolve_date(root, date):
+    """
+    Returns a dict mapping the repos to the revisions to which the given date
+    resolves via the date index or None if the VCS has to resolve the date.
+    """
+    timestamp = parse_date(date)
+    if timestamp is None:
+        return None
+    # Only the project and its current dependencies get updated
+    names = ['.'] + list(load_repo_config(root)['repos'])
+    index = refresh_date_index(root, names)
+    revision = {}
+    for name in names:
+        rev = index.find(name, timestamp)
+        if rev is not None:
+            revision[name] = rev
+    return revision
+
 def push_project(root, committed=False, deploy=True):
     if deploy:
         deploy_url, repo_url, revisions = load_revisions(root, only_committed=committed)
@@ -546,11 +1061,13 @@ def clone_cmd(args):
 
 def build_cmd(args):
     root = get_project_root_ensured()
-    build_project(root)
+    build_project(root, rescan=args.rescan)
 
 def pull_cmd(args):
     root = get_project_root_ensured()
     build_project(root, pull_repo)
+    # Keep the date index up to date, so the next update -d doesn't have to
+    refresh_date_index(root)
 
 def fetch_cmd(args):
     root = get_project_root_ensured()
@@ -717,7 +1234,11 @@ def update_cmd(args):
     else:
         revision = parse_revspec(args.revision)
     date = args.date or None
-    build_project(root, update_repo, revision=revision, date=date,
+    resolved = None
+    if date and not revision:
+        # With an explicit revision the date wins like it always did
+        resolved = resolve_date(root, date)
+    build_project(root, update_repo, revision=revision, date=date, resolved=resolved,
                   active_branch=active_branch, branches=branches)
 
 def revert_cmd(args):
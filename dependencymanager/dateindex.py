@@ -0,0 +1,59 @@
+from .jsonfile import load_json, save_json
+from datetime import datetime
+import os
+import time
+
+DATE_INDEX_NAME = '.dm-dates.json'
+DATE_INDEX_VERSION = 2
+# Dates in other formats (e.g., without a time, which git and hg interpret
+# differently) get resolved by the VCS
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+
+def parse_date(date):
+    """
+    Returns the timestamp of the given date (in local time) or None if the
+    date's format isn't supported.
+    """
+    date = date.strip()
+    for format in DATE_FORMATS:
+        try:
+            parsed = datetime.strptime(date, format)
+        except ValueError:
+            continue
+        return time.mktime(parsed.timetuple())
+    return None
+
+def get_date_index_path(root):
+    return os.path.join(root, '.repos', DATE_INDEX_NAME)
+
+class DateIndex(object):
+    """
+    Caches the commit dates of the project's repos, so a date can be
+    resolved to revisions without calling the VCS.
+    """
+    def __init__(self, root):
+        self.path = get_date_index_path(root)
+        # Maps repo names to the result of LocalRepo.get_commit_dates()
+        self.repos = {}
+
+    @classmethod
+    def load(cls, root):
+        index = cls(root)
+        data = load_json(index.path, DATE_INDEX_VERSION)
+        if data is not None:
+            index.repos = data['repos']
+        return index
+
+    def save(self):
+        save_json(self.path, DATE_INDEX_VERSION, {'repos': self.repos})
+
+    def find(self, name, timestamp):
+        """Returns the newest revision of the given repo up to timestamp."""
+        entry = self.repos.get(name)
+        if entry is None:
+            return None
+        # Commits are ordered like the VCS would search them
+        for commit_time, revision in entry['commits']:
+            if commit_time <= timestamp:
+                return revision
+        return None
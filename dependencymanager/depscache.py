@@ -0,0 +1,82 @@
+from .jsonfile import load_json, save_json
+from ConfigParser import RawConfigParser
+import os
+import time
+
+# Parsed .deps files by path. An entry is only used while the file's mtime
+# and size are unchanged.
+deps_cache = {}
+# Optional on-disk copy of deps_cache, so other dm processes can reuse it
+DEPS_CACHE_FILE = None
+DEPS_CACHE_VERSION = 1
+deps_cache_changed = False
+# Files modified within this many seconds could be changed again without
+# changing their mtime, so they don't get cached
+RACY_INTERVAL = 2
+
+def get_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+def parse_deps(path):
+    config = RawConfigParser()
+    config.read(path)
+    return {section: config.items(section) for section in config.sections()}
+
+def read_deps(path):
+    """Returns the items of all sections of the given .deps file."""
+    global deps_cache_changed
+    path = os.path.abspath(path)
+    stamp = get_stamp(path)
+    cached = deps_cache.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    sections = parse_deps(path) if stamp is not None else {}
+    if stamp is None or time.time() - stamp[0] > RACY_INTERVAL:
+        deps_cache[path] = [stamp, sections]
+        deps_cache_changed = True
+    return sections
+
+def get_cache_root():
+    cache_root = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_root, 'dm')
+
+def get_default_cache_file():
+    return os.path.join(get_cache_root(), 'deps-cache.json')
+
+def encode_strings(value):
+    # RawConfigParser returns byte strings, but json returns unicode strings
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [encode_strings(item) for item in value]
+    if isinstance(value, dict):
+        return {key: encode_strings(item) for key, item in value.items()}
+    return value
+
+def load_deps_cache(path=None):
+    global DEPS_CACHE_FILE
+    DEPS_CACHE_FILE = path or get_default_cache_file()
+    data = load_json(DEPS_CACHE_FILE, DEPS_CACHE_VERSION)
+    if data is None:
+        return
+    for path, (stamp, sections) in data['files'].items():
+        deps_cache.setdefault(path, [stamp, encode_strings(sections)])
+
+def save_deps_cache():
+    global deps_cache_changed
+    if DEPS_CACHE_FILE is None or not deps_cache_changed:
+        return
+    # Forget files which don't exist, anymore
+    files = {path: entry for path, entry in deps_cache.items()
+             if entry[0] is not None}
+    try:
+        save_json(DEPS_CACHE_FILE, DEPS_CACHE_VERSION, {'files': files})
+    except (IOError, OSError):
+        # The cache is just an optimization
+        return
+    deps_cache_changed = False
@@ -0,0 +1,171 @@
+import os
+import re
+
+# Reads git metadata (config, HEAD, refs) directly from the .git folder, so
+# frequently needed information doesn't require starting a git process.
+
+git_section_re = re.compile(r'^\[\s*([^\s"\]]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]\s*(.*)$',
+                            re.UNICODE)
+git_option_re = re.compile(r'^([A-Za-z][-A-Za-z0-9]*)\s*(?:=\s*(.*))?$', re.UNICODE)
+git_sha_re = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
+
+GIT_ESCAPES = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+
+class UnsupportedGitFormat(Exception):
+    pass
+
+def parse_git_value(value):
+    result = []
+    quoted = False
+    index = 0
+    while index < len(value):
+        char = value[index]
+        if char == '"':
+            quoted = not quoted
+        elif char == '\\' and index + 1 < len(value):
+            index += 1
+            if value[index] not in GIT_ESCAPES:
+                raise UnsupportedGitFormat('Invalid escape sequence in %r' % value)
+            result.append(GIT_ESCAPES[value[index]])
+        elif char in '#;' and not quoted:
+            break
+        else:
+            result.append(char)
+        index += 1
+    return ''.join(result).strip()
+
+def read_git_config(path):
+    """
+    Returns a dict which maps (section, subsection) to the section's options.
+    Section and option names are lowercased, just like git does it.
+    """
+    config = {}
+    section = None
+    with open(path, 'r') as fp:
+        lines = fp.read().splitlines()
+    while lines:
+        line = lines.pop(0).strip()
+        # Handle line continuations
+        while line.endswith('\\') and not line.endswith('\\\\') and lines:
+            line = line[:-1] + lines.pop(0).rstrip()
+        if not line or line[0] in '#;':
+            continue
+        match = git_section_re.match(line)
+        if match:
+            name, subsection, rest = match.groups()
+            if '.' in name and subsection is None:
+                name, subsection = name.lower().split('.', 1)
+            elif subsection is not None:
+                subsection = re.sub(r'\\(.)', r'\1', subsection)
+            section = config.setdefault((name.lower(), subsection), {})
+            if not rest or rest[0] in '#;':
+                continue
+            line = rest
+        match = git_option_re.match(line)
+        if not match or section is None:
+            raise UnsupportedGitFormat('Could not parse line %r in %s' % (line, path))
+        option, value = match.groups()
+        section[option.lower()] = 'true' if value is None else parse_git_value(value)
+    return config
+
+class GitMetadata(object):
+    def __init__(self, root):
+        self.git_dir = os.path.join(root, '.git')
+        if os.path.exists(os.path.join(self.git_dir, 'commondir')) or \
+                os.path.exists(os.path.join(self.git_dir, 'reftable')):
+            raise UnsupportedGitFormat('Unsupported repository layout in %s' % root)
+        self.config = read_git_config(os.path.join(self.git_dir, 'config'))
+        core = self.config.get(('core', None), {})
+        extensions = self.config.get(('extensions', None), {})
+        if core.get('repositoryformatversion', '0') not in ('0', '1') or \
+                extensions.get('refstorage', 'files') != 'files':
+            raise UnsupportedGitFormat('Unsupported repository format in %s'
+                                       % self.git_dir)
+
+    def get_remote_url(self, remote='origin'):
+        return self.config.get(('remote', remote), {}).get('url')
+
+    def _read_ref_file(self, name):
+        path = os.path.join(self.git_dir, *name.split('/'))
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as fp:
+            return fp.read().strip()
+
+    def packed_refs(self):
+        refs = {}
+        path = os.path.join(self.git_dir, 'packed-refs')
+        if not os.path.exists(path):
+            return refs
+        with open(path, 'r') as fp:
+            for line in fp.read().splitlines():
+                # Skip the header and peeled tag lines
+                if not line or line[0] in '#^':
+                    continue
+                revision, name = line.split(' ', 1)
+                refs[name] = revision
+        return refs
+
+    def symbolic_ref(self, name):
+        """Returns the ref name pointed to by a symbolic ref or None."""
+        content = self._read_ref_file(name)
+        if content and content.startswith('ref:'):
+            return content[4:].strip()
+        return None
+
+    def refs(self, prefix, packed=None):
+        """
+        Returns a dict of all (non-symbolic) refs below the given prefix
+        (e.g., "refs/heads/") mapped to their revisions.
+        """
+        if packed is None:
+            packed = self.packed_refs()
+        refs = {name: revision for name, revision in packed.items()
+                if name.startswith(prefix)}
+        base = os.path.join(self.git_dir, *prefix.rstrip('/').split('/'))
+        for dirpath, dirnames, filenames in os.walk(base):
+            for filename in filenames:
+                if filename.endswith('.lock'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.git_dir).replace(os.sep, '/')
+                with open(path, 'r') as fp:
+                    content = fp.read().strip()
+                if content.startswith('ref:'):
+                    refs.pop(name, None)
+                    continue
+                if not git_sha_re.match(content):
+                    raise UnsupportedGitFormat('Unexpected content in %s' % path)
+                refs[name] = content
+        return refs
+
+    def resolve(self, name, packed=None):
+        for _ in range(10):
+            content = self._read_ref_file(name)
+            if content is None:
+                if packed is None:
+                    packed = self.packed_refs()
+                return packed.get(name)
+            if not content.startswith('ref:'):
+                if not git_sha_re.match(content):
+                    raise UnsupportedGitFormat('Unexpected content in %s' % name)
+                return content
+            name = content[4:].strip()
+        raise UnsupportedGitFormat('Too many levels of symbolic refs: %s' % name)
+
+    def head(self):
+        """Returns a tuple (branch, revision). branch is None if HEAD is detached."""
+        branch = self.symbolic_ref('HEAD')
+        revision = self.resolve('HEAD')
+        if branch is not None:
+            if not branch.startswith('refs/heads/'):
+                raise UnsupportedGitFormat('Unexpected HEAD in %s' % self.git_dir)
+            branch = branch[len('refs/heads/'):]
+        return branch, revision
+
+    def default_branch(self, remote='origin'):
+        name = self.symbolic_ref('refs/remotes/%s/HEAD' % remote)
+        prefix = 'refs/remotes/%s/' % remote
+        if name is None or not name.startswith(prefix):
+            return None
+        return name[len(prefix):]
@@ -0,0 +1,154 @@
+import os
+import platform
+import re
+
+# Reads hg metadata (hgrc, bookmarks) directly from the .hg folder, so
+# frequently needed information doesn't require starting an hg process.
+
+hg_section_re = re.compile(r'^\[([^\[]+)\]', re.UNICODE)
+hg_item_re = re.compile(r'^([^=\s][^=]*?)\s*=\s*(.*\S|)', re.UNICODE)
+hg_continuation_re = re.compile(r'^\s+(\S|\S.*\S)\s*$', re.UNICODE)
+hg_node_re = re.compile(r'^[0-9a-f]{40}$')
+
+# Repository requirements which don't change where or how bookmarks are stored
+KNOWN_REQUIREMENTS = {
+    'revlogv1', 'store', 'fncache', 'shared', 'relshared', 'dotencode',
+    'generaldelta', 'sparserevlog', 'treemanifest', 'manifestv2', 'lfs',
+    'largefiles', 'bookmarksinstore', 'persistent-nodemap', 'share-safe',
+    'revlog-compression-zstd', 'exp-sparse', 'narrowhg-experimental',
+    'dirstate-v2', 'internal-phase', 'exp-rc-dirstate-v2',
+}
+
+class UnsupportedHGFormat(Exception):
+    pass
+
+def read_hgrc(path):
+    """
+    Returns a dict which maps section names to the section's options.
+    Unlike ConfigParser this understands hg's syntax and doesn't interpolate
+    values (so URLs containing "%" work). %include directives are ignored.
+    """
+    config = {}
+    section = None
+    option = None
+    with open(path, 'r') as fp:
+        lines = fp.read().splitlines()
+    for line in lines:
+        if section is not None and option is not None:
+            match = hg_continuation_re.match(line)
+            if match:
+                config[section][option] += '\n' + match.group(1)
+                continue
+        option = None
+        if not line.strip() or line[0] in '#;':
+            continue
+        match = hg_section_re.match(line)
+        if match:
+            section = match.group(1).strip()
+            config.setdefault(section, {})
+            continue
+        if line.startswith('%unset '):
+            if section is not None:
+                config[section].pop(line.split(None, 1)[1].strip(), None)
+            continue
+        if line.startswith('%include '):
+            continue
+        match = hg_item_re.match(line)
+        if not match or section is None:
+            raise UnsupportedHGFormat('Could not parse line %r in %s' % (line, path))
+        option, value = match.groups()
+        config[section][option] = value
+    return config
+
+def get_user_hgrc_paths():
+    """
+    Returns the existing system-wide and user hgrc files in the order in which
+    hg reads them. Like in hg, HGRCPATH replaces the default locations.
+    """
+    if 'HGRCPATH' in os.environ:
+        candidates = os.environ['HGRCPATH'].split(os.pathsep)
+    elif platform.system() == 'Windows':
+        home = os.path.expanduser('~')
+        candidates = [os.path.join(home, 'mercurial.ini'), os.path.join(home, '.hgrc')]
+    else:
+        config_home = (os.environ.get('XDG_CONFIG_HOME') or
+                       os.path.join(os.path.expanduser('~'), '.config'))
+        candidates = ['/etc/mercurial/hgrc', '/etc/mercurial/hgrc.d',
+                      os.path.join(os.path.expanduser('~'), '.hgrc'),
+                      os.path.join(config_home, 'hg', 'hgrc')]
+    paths = []
+    for path in candidates:
+        if not path:
+            continue
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.endswith('.rc'))
+        elif os.path.isfile(path):
+            paths.append(path)
+    return paths
+
+def is_extension_enabled(configs, names):
+    # Returns whether one of the given extension names is enabled by the
+    # configs, where later configs override earlier ones
+    enabled = False
+    for config in configs:
+        for name, value in config.get('extensions', {}).items():
+            if name in names:
+                enabled = not value.startswith('!')
+    return enabled
+
+class HGMetadata(object):
+    def __init__(self, root):
+        self.hg_dir = os.path.join(root, '.hg')
+        self.requirements = set()
+        # With share-safe the store requirements live in a separate file
+        for requires in (os.path.join(self.hg_dir, 'requires'),
+                         os.path.join(self.hg_dir, 'store', 'requires')):
+            if os.path.exists(requires):
+                with open(requires, 'r') as fp:
+                    self.requirements.update(fp.read().split())
+        unknown = self.requirements - KNOWN_REQUIREMENTS
+        if unknown:
+            raise UnsupportedHGFormat('Unknown repository requirements in %s: %s'
+                                      % (root, ', '.join(sorted(unknown))))
+        if os.path.exists(os.path.join(self.hg_dir, 'sharedpath')):
+            # Bookmarks might be stored in the share source
+            raise UnsupportedHGFormat('Shared repositories are not supported: %s' % root)
+
+    def get_config(self):
+        path = os.path.join(self.hg_dir, 'hgrc')
+        if not os.path.exists(path):
+            return {}
+        return read_hgrc(path)
+
+    def get_path(self, name='default'):
+        return self.get_config().get('paths', {}).get(name)
+
+    def active_bookmark(self):
+        # Depending on the hg version the active bookmark is stored in either file
+        for filename in ('bookmarks.current', 'activebookmark'):
+            path = os.path.join(self.hg_dir, filename)
+            if os.path.exists(path):
+                with open(path, 'r') as fp:
+                    return fp.read().strip() or None
+        return None
+
+    def bookmarks(self):
+        """Returns a dict which maps bookmark names to their full hex nodes."""
+        if 'bookmarksinstore' in self.requirements:
+            path = os.path.join(self.hg_dir, 'store', 'bookmarks')
+        else:
+            path = os.path.join(self.hg_dir, 'bookmarks')
+        bookmarks = {}
+        if not os.path.exists(path):
+            return bookmarks
+        with open(path, 'r') as fp:
+            for line in fp.read().splitlines():
+                if not line.strip():
+                    continue
+                parts = line.split(' ', 1)
+                if len(parts) != 2 or not hg_node_re.match(parts[0]):
+                    raise UnsupportedHGFormat('Unexpected line %r in %s' % (line, path))
+                bookmarks[parts[1]] = parts[0]
+        return bookmarks
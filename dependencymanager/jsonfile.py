@@ -0,0 +1,35 @@
+import json
+import os
+import platform
+
+def load_json(path, version):
+    """
+    Returns the data saved by save_json() or None if the file doesn't exist,
+    can't be parsed or has a different version.
+    """
+    try:
+        with open(path, 'rb') as fp:
+            data = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != version:
+        return None
+    return data
+
+def save_json(path, version, data, **kwargs):
+    """
+    Atomically replaces the file with the given data. kwargs get passed to
+    json.dump().
+    """
+    data = dict(data, version=version)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Other dm processes might save the same file at the same time
+    temp_path = '%s.%d' % (path, os.getpid())
+    with open(temp_path, 'wb') as fp:
+        json.dump(data, fp, **kwargs)
+    # On Windows rename() can't replace files
+    if platform.system() == 'Windows' and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
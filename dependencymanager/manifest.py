@@ -0,0 +1,140 @@
+from .jsonfile import load_json, save_json
+from .repo import get_local_repo
+import hashlib
+import os
+
+MANIFEST_NAME = '.dm-manifest.json'
+MANIFEST_VERSION = 2
+
+def get_file_hash(path):
+    try:
+        with open(path, 'rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def get_link_dir(name):
+    # Link names always use "/" as the separator
+    return name.rsplit('/', 1)[0] if '/' in name else ''
+
+def get_link_target(root, name, target):
+    # Links point to their target in .repos via a relative path
+    path = os.path.join(root, name)
+    return os.path.relpath(os.path.join(root, '.repos', target), os.path.dirname(path))
+
+class Manifest(object):
+    """
+    Remembers the result of the last successful build, so a build can be
+    skipped if neither the .deps files nor the repositories' sources or the
+    links have changed since then.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, '.repos', MANIFEST_NAME)
+        # Maps .deps paths (relative to root) to their content hash
+        self.deps = {}
+        # Maps repo names to their source and the hash of their config file
+        self.sources = {}
+        # Maps link names to their target (relative to .repos)
+        self.links = {}
+        # Maps the directories containing links to their mtime, so links which
+        # were added to those directories by hand can be detected
+        self.link_dirs = {}
+        # Options which influence the result of a build
+        self.settings = {}
+        # Names of the repos which got a sparse checkout
+        self.sparse = []
+
+    @classmethod
+    def load(cls, root):
+        manifest = cls(root)
+        data = load_json(manifest.path, MANIFEST_VERSION)
+        if data is not None:
+            manifest.deps = data['deps']
+            manifest.sources = data['sources']
+            manifest.links = data['links']
+            manifest.settings = data.get('settings', {})
+            manifest.link_dirs = data['link_dirs']
+            manifest.sparse = data.get('sparse', [])
+        return manifest
+
+    def save(self):
+        data = {'deps': self.deps, 'sources': self.sources, 'links': self.links,
+                'settings': self.settings, 'link_dirs': self.link_dirs,
+                'sparse': self.sparse}
+        save_json(self.path, MANIFEST_VERSION, data, indent=1, sort_keys=True)
+
+    def get_source(self, name, repo):
+        # Only call get_source() if the repo's config has changed
+        config_hash = get_file_hash(repo.get_config_path())
+        cached = self.sources.get(name)
+        if cached is not None and cached[1] == config_hash:
+            return cached[0]
+        return repo.get_source()
+
+    def is_up_to_date(self, settings):
+        if not self.deps or settings != self.settings:
+            return False
+        for path, deps_hash in self.deps.items():
+            if get_file_hash(os.path.join(self.root, path)) != deps_hash:
+                return False
+        deps_root = os.path.join(self.root, '.repos')
+        names = set()
+        if os.path.isdir(deps_root):
+            names = set(name for name in os.listdir(deps_root)
+                        if not name.startswith('.'))
+        if names != set(self.sources):
+            return False
+        for name, (source, config_hash) in self.sources.items():
+            repo = get_local_repo(os.path.join(deps_root, name))
+            if repo is None or get_file_hash(repo.get_config_path()) != config_hash:
+                return False
+        for name, target in self.links.items():
+            path = os.path.join(self.root, name)
+            if not os.path.islink(path) or \
+                    os.readlink(path) != get_link_target(self.root, name, target):
+                return False
+        for directory, mtime in self.link_dirs.items():
+            if get_mtime(os.path.join(self.root, directory)) != mtime:
+                return False
+        return True
+
+    def find_links(self):
+        """
+        Returns the names of the recorded links and of all other links in the
+        directories containing them.
+        """
+        names = set(name for name in self.links
+                    if os.path.islink(os.path.join(self.root, name)))
+        for directory in self.link_dirs:
+            path = os.path.join(self.root, directory)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if os.path.islink(os.path.join(path, name)):
+                    names.add(directory + '/' + name if directory else name)
+        return sorted(names)
+
+    def update(self, repos, links, settings, sparse=()):
+        """Records the state after a build of the given repos and links."""
+        deps_root = os.path.join(self.root, '.repos')
+        self.deps = {'.deps': get_file_hash(os.path.join(self.root, '.deps'))}
+        self.sources = {}
+        for name, source in repos.items():
+            self.deps['.repos/%s/.deps' % name] = \
+                get_file_hash(os.path.join(deps_root, name, '.deps'))
+            repo = get_local_repo(os.path.join(deps_root, name))
+            self.sources[name] = [source, get_file_hash(repo.get_config_path())]
+        self.links = dict(links)
+        self.link_dirs = {}
+        for name in links:
+            directory = get_link_dir(name)
+            self.link_dirs[directory] = get_mtime(os.path.join(self.root, directory))
+        self.settings = dict(settings)
+        self.sparse = sorted(sparse)
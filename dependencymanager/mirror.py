@@ -0,0 +1,77 @@
+from .depscache import get_cache_root
+import hashlib
+import os
+import shutil
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Directory with bare mirrors of remote repos (None if mirrors are disabled)
+MIRROR_ROOT = None
+
+def enable_mirrors(path=None):
+    global MIRROR_ROOT
+    MIRROR_ROOT = path or os.path.join(get_cache_root(), 'mirrors')
+
+def get_mirror_path(source, repo_type):
+    """Returns the mirror path for the given source or None if not mirrored."""
+    # Local repos can already be cloned with hardlinks
+    if MIRROR_ROOT is None or os.path.exists(source):
+        return None
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    name = hashlib.sha1(source).hexdigest()
+    return os.path.join(MIRROR_ROOT, '%s.%s' % (name, repo_type))
+
+def create_mirror(path, clone):
+    """
+    Calls clone(temp_path) and moves the result to path, so a failed clone
+    doesn't leave a broken mirror behind.
+    """
+    temp_path = '%s.tmp-%d' % (path, os.getpid())
+    shutil.rmtree(temp_path, ignore_errors=True)
+    try:
+        output = clone(temp_path)
+    except:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+    os.rename(temp_path, path)
+    return output
+
+class MirrorLock(object):
+    """Serializes access to a mirror across threads and dm processes."""
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self.fp = None
+
+    def __enter__(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                # Another process created it in the meantime
+                pass
+        self.fp = open(self.path, 'a+')
+        self.fp.seek(0)
+        if fcntl is not None:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(self.fp.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except IOError:
+                    time.sleep(0.1)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+        else:
+            self.fp.seek(0)
+            msvcrt.locking(self.fp.fileno(), msvcrt.LK_UNLCK, 1)
+        self.fp.close()
+        self.fp = None
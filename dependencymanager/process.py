@@ -0,0 +1,129 @@
+from subprocess import Popen, call
+from threading import Lock, Timer, local
+import os
+import platform
+import signal
+import time
+
+# Timeouts (in seconds) per action (e.g., "pull") for calls which capture their
+# output. The "default" entry applies to all other actions.
+TIMEOUTS = {}
+# Time a process gets for cleaning up (e.g., releasing repo locks) before it's
+# killed forcefully
+KILL_GRACE_PERIOD = 5
+
+call_context = local()
+running_processes = {}
+running_processes_lock = Lock()
+# Process groups which get killed forcefully after the grace period
+kill_timers = {}
+watchdogs = set()
+
+def set_timeouts(timeouts):
+    TIMEOUTS.clear()
+    TIMEOUTS.update(timeouts)
+
+def with_action(func, action):
+    # Calls made by func get the timeout configured for the given action
+    def wrapper(*args, **kwargs):
+        previous = getattr(call_context, 'action', None)
+        call_context.action = action
+        try:
+            return func(*args, **kwargs)
+        finally:
+            call_context.action = previous
+    return wrapper
+
+def get_timeout():
+    action = getattr(call_context, 'action', None)
+    return TIMEOUTS.get(action, TIMEOUTS.get('default'))
+
+def start_process(run, new_group=False, **kwargs):
+    # Processes which might have to be killed get their own process group,
+    # so their children (e.g., ssh) get killed, too
+    if new_group:
+        if platform.system() == 'Windows':
+            kwargs['creationflags'] = kwargs.get('creationflags', 0) | 0x200
+        else:
+            kwargs['preexec_fn'] = os.setsid
+    process = Popen(run, **kwargs)
+    with running_processes_lock:
+        running_processes[process] = new_group
+    return process
+
+def finish_process(process):
+    with running_processes_lock:
+        running_processes.pop(process, None)
+
+def kill_process(process, new_group=True):
+    try:
+        if platform.system() == 'Windows':
+            with open(os.devnull, 'w') as devnull:
+                call(['taskkill', '/F', '/T', '/PID', str(process.pid)],
+                     stdout=devnull, stderr=devnull)
+        elif new_group:
+            os.killpg(process.pid, signal.SIGTERM)
+            timer = Timer(KILL_GRACE_PERIOD, kill_process_group, [process.pid])
+            timer.daemon = True
+            with running_processes_lock:
+                kill_timers[process.pid] = timer
+            timer.start()
+        else:
+            process.terminate()
+    except OSError:
+        # The process has already terminated
+        pass
+
+def kill_process_group(pgid):
+    with running_processes_lock:
+        kill_timers.pop(pgid, None)
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def process_group_exists(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except OSError:
+        return False
+    return True
+
+def kill_running_processes():
+    with running_processes_lock:
+        processes = running_processes.items()
+        running_processes.clear()
+        for watchdog in watchdogs:
+            watchdog.timer.cancel()
+        watchdogs.clear()
+    for process, new_group in processes:
+        if process.poll() is None:
+            kill_process(process, new_group)
+
+def wait_for_killed_processes():
+    # Killed processes get their grace period, even if dm is about to exit
+    with running_processes_lock:
+        timers = kill_timers.items()
+    for pgid, timer in timers:
+        while timer.is_alive() and process_group_exists(pgid):
+            time.sleep(0.05)
+        timer.cancel()
+
+class Watchdog(object):
+    """Kills the given process (and its children) when the timeout expires."""
+    def __init__(self, process, timeout):
+        self.expired = False
+        self.timer = Timer(timeout, self.expire, [process])
+        self.timer.daemon = True
+        with running_processes_lock:
+            watchdogs.add(self)
+        self.timer.start()
+
+    def expire(self, process):
+        self.expired = True
+        kill_process(process)
+
+    def cancel(self):
+        self.timer.cancel()
+        with running_processes_lock:
+            watchdogs.discard(self)
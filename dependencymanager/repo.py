@@ -1,6 +1,21 @@
+from .cmdserver import CommandServer, CommandServerError
+from .depscache import encode_strings
+from .gitmeta import GitMetadata, UnsupportedGitFormat
+from .hgmeta import (HGMetadata, UnsupportedHGFormat, get_user_hgrc_paths,
+    is_extension_enabled, read_hgrc)
+from .mirror import get_mirror_path, create_mirror, MirrorLock
+from .process import (start_process, finish_process, get_timeout, Watchdog,
+    TIMEOUTS)
+from .spool import SpooledOutput, CHUNK_SIZE
+from .trace import span
 from ConfigParser import ConfigParser
+from copy import deepcopy
 from cStringIO import StringIO
-from subprocess import Popen, PIPE, STDOUT
+from functools import wraps
+from subprocess import PIPE, STDOUT
+from threading import Lock
+from urlparse import urlparse
+import json
 import os
 import platform
 import re
@@ -9,8 +24,41 @@ import sys
 # TODO: replace sys.exit() with exceptions
 
 DEFAULT_BRANCH = '$default'
+# Maps repo roots to whether hg knows dmext's dmstate command there, since
+# the extension can be enabled per repo
+dmstate_available = {}
+# Names under which dmext can be enabled in the [extensions] section
+DMEXT_NAMES = ('dmext', 'hgext.dmext', 'hgext3rd.dmext')
+# The parsed system-wide and user hgrc files or None if they haven't been
+# read, yet
+user_hgrc_configs = None
+# Everything LocalRepo.snapshot() can return
+SNAPSHOT_FIELDS = ('revision', 'dirty', 'active_branch', 'branches', 'divergent',
+                   'source')
+
+def cached(func):
+    # Caches the result until a method decorated with @modifies gets called
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in self._cache:
+            self._cache[key] = func(self, *args, **kwargs)
+        # Callers are allowed to modify the result
+        return deepcopy(self._cache[key])
+    return wrapper
+
+def modifies(func):
+    # Some methods read metadata after modifying the repo, so the cache also
+    # gets cleared before calling them
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self._cache.clear()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self._cache.clear()
+    return wrapper
 
-hg_rev_re = re.compile(r'changeset:\s*(\d+):.*', re.UNICODE)
 hg_bookmark_re = re.compile(r'\s*(\*)?\s*([^\s]+)\s*-?\d+:([^\s]+)', re.UNICODE)
 hg_divergent_re = re.compile('divergent bookmark ([^\s]+) stored as .*', re.UNICODE)
 git_branch_re = re.compile(r'\s*(\*)?\s*([^\s]+)\s*([^\s]+).*', re.UNICODE)
@@ -23,7 +71,10 @@ class RemoteRepo(object):
     def get_default_destination(self):
         return self.source.replace('\\', '/').rstrip('/').rsplit('/', 1)[-1]
 
-    def clone(self, destination, branch):
+    def clone(self, destination, depth=None, filter=None, checkout=True):
+        # depth and filter only get used by repo types which support shallow
+        # or partial clones. With checkout=False the working copy stays empty
+        # until LocalRepo.checkout() or update() gets called.
         raise NotImplementedError()
 
 class LocalRepo(object):
@@ -32,11 +83,62 @@ class LocalRepo(object):
         # (e.g., a user would diff a file from his current path instead of from root)
         self.root = root
         self.path = path if path is not None else root
+        # Metadata (branches, source, etc.) which is valid until the repo changes
+        self._cache = {}
 
     def get_source(self):
         raise NotImplementedError()
 
+    def get_config_path(self):
+        # The file which defines the repo's source
+        raise NotImplementedError()
+
     def get_revision(self, no_uncommitted=True):
+        fields = ('revision', 'dirty') if no_uncommitted else ('revision',)
+        snapshot = self.snapshot(fields)
+        if snapshot.get('dirty'):
+            raise ValueError('Repository has uncommitted changes: %s' % self.root)
+        return snapshot['revision']
+
+    def snapshot(self, fields=SNAPSHOT_FIELDS):
+        """
+        Returns a dict with the given SNAPSHOT_FIELDS. Fields which the VCS
+        reports together are answered by a single query.
+        """
+        fields = set(fields)
+        if not fields.issubset(SNAPSHOT_FIELDS):
+            raise ValueError('Unknown snapshot fields: %s'
+                             % ', '.join(sorted(fields.difference(SNAPSHOT_FIELDS))))
+        result = {}
+        if 'dirty' in fields:
+            result['revision'], result['dirty'] = self._working_state()
+        elif 'revision' in fields:
+            result['revision'] = self._committed_revision()
+        if fields & {'active_branch', 'branches', 'divergent'}:
+            result['active_branch'], result['branches'], result['divergent'] = \
+                self._branch_state()
+        if 'source' in fields:
+            result['source'] = self.get_source()
+        return {field: result[field] for field in fields}
+
+    def _working_state(self):
+        # Returns the revision and whether there are uncommitted changes
+        raise NotImplementedError()
+
+    def _committed_revision(self):
+        # Returns the revision without checking for uncommitted changes
+        raise NotImplementedError()
+
+    def _branch_state(self):
+        # Returns the active branch, all branches and the divergent branches
+        raise NotImplementedError()
+
+    def get_commit_dates(self, entry=None):
+        """
+        Returns a dict whose 'commits' are (commit time, revision) pairs in the
+        order in which the VCS searches them for a date. entry is the previous
+        result, which only gets extended by the new commits if possible.
+        """
         raise NotImplementedError()
 
     def get_branch_name(self, branch):
@@ -77,7 +179,24 @@ class LocalRepo(object):
     def delete_branch(self, name):
         raise NotImplementedError()
 
-    def update(self, revision=None, date=None, clean=False):
+    def update(self, revision=None, date=None, clean=False, resolved=None):
+        # resolved can contain the revision to which date got resolved by the
+        # date index
+        raise NotImplementedError()
+
+    def checkout(self):
+        # Populates the working copy of a repo cloned with checkout=False
+        raise NotImplementedError()
+
+    def get_checkout_file(self, path):
+        """
+        Returns the content of the given file in the revision which checkout()
+        checks out or None if the file doesn't exist there.
+        """
+        raise NotImplementedError()
+
+    def latest_revision(self, revisions):
+        # Returns the newest of the given revisions
         raise NotImplementedError()
 
     def fetch(self):
@@ -119,31 +238,137 @@ class LocalRepo(object):
     def heads(self, divergent_only=True):
         raise NotImplementedError()
 
+    def sparse_checkout(self, paths=None):
+        """
+        Limits the working copy to the given paths (relative to the repo
+        root) or restores the full working copy if paths is None.
+        """
+        raise NotImplementedError()
+
 class RemoteFakeLocalRepo(RemoteRepo):
-    def clone(self, destination):
+    def clone(self, destination, depth=None, filter=None, checkout=True):
         return 'Cloning not possible for local repos'
 
 class RemoteHGRepo(RemoteRepo):
-    def clone(self, destination):
-        return call_hg('clone', self.source, destination, pipe=True)
+    def clone(self, destination, depth=None, filter=None, checkout=True):
+        args = [] if checkout else ['-U']
+        mirror = get_mirror_path(self.source, 'hg')
+        if mirror is None:
+            return call_hg('clone', *(args + [self.source, destination]), pipe=True)
+        with MirrorLock(mirror):
+            if os.path.exists(mirror):
+                output = call_hg('pull', cwd=mirror, pipe=True)
+            else:
+                output = create_mirror(mirror, lambda path: call_hg(
+                    'clone', '-U', self.source, path, pipe=True))
+            # Cloning from a local repo uses hardlinks
+            output += call_hg('clone', *(args + [mirror, destination]), pipe=True)
+        set_hg_config(destination, 'paths', 'default', self.source)
+        return output
+
+def set_hg_config(root, section, name, value):
+    # Sets the given option in the repo's .hg/hgrc
+    path = os.path.join(root, '.hg', 'hgrc')
+    try:
+        with open(path, 'r') as fp:
+            lines = fp.readlines()
+    except IOError:
+        lines = []
+    option = ('%s = %s' % (name, value)).rstrip() + '\n'
+    current = None
+    section_end = None
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith('['):
+            current = stripped.strip('[]').strip()
+            if current == section:
+                section_end = index + 1
+        elif current == section and stripped.split('=', 1)[0].strip() == name:
+            lines[index] = option
+            break
+        elif current == section and stripped and not stripped.startswith(('#', ';')):
+            section_end = index + 1
+    else:
+        if section_end is None:
+            if lines and not lines[-1].endswith('\n'):
+                lines.append('\n')
+            lines.append('[%s]\n' % section)
+            section_end = len(lines)
+        lines.insert(section_end, option)
+    with open(path, 'w') as fp:
+        fp.writelines(lines)
 
 class LocalHGRepo(LocalRepo):
+    def _metadata(self):
+        # Returns None if the repository can't be read without hg
+        try:
+            return HGMetadata(self.root)
+        except (UnsupportedHGFormat, IOError, OSError):
+            return None
+
+    def get_config_path(self):
+        return os.path.join(self.root, '.hg', 'hgrc')
+
+    @cached
     def get_source(self):
+        metadata = self._metadata()
+        if metadata is not None:
+            try:
+                return metadata.get_path('default') or '[local]'
+            except (UnsupportedHGFormat, IOError, OSError):
+                pass
         config = ConfigParser()
         config.read(os.path.join(self.root, '.hg', 'hgrc'))
         if not config.has_option('paths', 'default'):
             return '[local]'
         return config.get('paths', 'default')
 
-    def get_revision(self, no_uncommitted=True):
+    @cached
+    def _working_state(self):
+        # hg id returns the revision, the dirty flag and the branch at once
         pair = call_hg('id', '-i', '-b', pipe=True, cwd=self.root).strip()
         revision, branch = pair.split(' ', 1)
-        if revision.endswith('+') and no_uncommitted:
-            raise ValueError('Repository has uncommitted changes: %s' % self.root)
+        dirty = revision.endswith('+')
         if branch != 'default':
             revision = call_hg('id', '-r', 'default', '-i', pipe=True, cwd=self.root)
             revision = revision.strip()
-        return revision.rstrip('+')
+        return revision.rstrip('+'), dirty
+
+    def _committed_revision(self):
+        return self._working_state()[0]
+
+    def _branch_state(self):
+        active_branch, branches, needs_merge = self._bookmarks()
+        return active_branch, branches, list(needs_merge)
+
+    def get_commit_dates(self, entry=None):
+        # hg update -d picks the newest matching revision number
+        template = '{rev} {node|short} {date|hgdate}\n'
+        lines = []
+        if entry is not None:
+            try:
+                lines = call_hg('log', '-r', '%d:' % entry['tiprev'], '--template',
+                                template, pipe=True, cwd=self.root).strip().split('\n')
+            except ProcessError:
+                # The tip got stripped
+                pass
+        if lines and lines[0].split(' ')[1:2] == [entry['tip']]:
+            result = dict(entry)
+            lines = lines[1:]
+        else:
+            result = {'tiprev': -1, 'tip': None, 'commits': []}
+            lines = call_hg('log', '-r', 'all()', '--template', template, pipe=True,
+                            cwd=self.root).strip().split('\n')
+        new_commits = []
+        for line in lines:
+            if not line:
+                continue
+            rev, node, date = line.split(' ', 2)
+            result['tiprev'], result['tip'] = int(rev), node
+            new_commits.append([int(date.split(' ', 1)[0]), node])
+        new_commits.reverse()
+        result['commits'] = new_commits + result['commits']
+        return result
 
     def _get_real_bookmark_name(self, name):
         if '@' not in name:
@@ -155,18 +380,109 @@ class LocalHGRepo(LocalRepo):
             return real_name, True
         return real_name, False
 
+    def _read_bookmarks(self):
+        # Returns a list of (active, bookmark, revision) tuples or None if
+        # the bookmarks can't be read without hg
+        metadata = self._metadata()
+        if metadata is None:
+            return None
+        try:
+            bookmarks = metadata.bookmarks()
+            current = metadata.active_bookmark()
+        except (UnsupportedHGFormat, IOError, OSError):
+            return None
+        # Sorted like "hg bookmark" output, so divergent bookmarks come last
+        return [(name == current, name, node[:12])
+                for name, node in sorted(bookmarks.items())]
+
+    def _dmext_enabled(self):
+        # Returns whether dmext is enabled in one of the hgrc files or might be
+        # enabled in one which couldn't be parsed
+        global user_hgrc_configs
+        try:
+            if user_hgrc_configs is None:
+                user_hgrc_configs = [read_hgrc(path) for path in get_user_hgrc_paths()]
+            configs = list(user_hgrc_configs)
+            metadata = self._metadata()
+            if metadata is not None:
+                configs.append(metadata.get_config())
+            elif os.path.exists(self.get_config_path()):
+                configs.append(read_hgrc(self.get_config_path()))
+        except (UnsupportedHGFormat, IOError, OSError):
+            return True
+        return is_extension_enabled(configs, DMEXT_NAMES)
+
+    @cached
+    def _dmstate(self):
+        # Returns the output of dmext's dmstate command or None if the extension
+        # isn't loaded
+        if self.root not in dmstate_available and not self._dmext_enabled():
+            # Without dmext the command would just fail
+            dmstate_available[self.root] = False
+        if dmstate_available.get(self.root) is False:
+            return None
+        try:
+            output = call_hg('dmstate', pipe=True, cwd=self.root)
+        except ProcessError as error:
+            if 'unknown command' not in error.message:
+                raise
+            dmstate_available[self.root] = False
+            return None
+        dmstate_available[self.root] = True
+        # stderr is merged into the output, so warnings might precede the state
+        lines = output.strip().split('\n')
+        try:
+            return encode_strings(json.loads(lines[-1]))
+        except ValueError:
+            # Let the normal hg queries answer instead
+            return None
+
+    def _dmstate_bookmarks(self, state):
+        return [(name == state['active'], name, node)
+                for name, node in sorted(state['bookmarks'].items())]
+
+    def snapshot(self, fields=SNAPSHOT_FIELDS):
+        fields = set(fields)
+        if fields & {'revision', 'dirty'} and fields.issubset(SNAPSHOT_FIELDS):
+            # hg has to be called anyway, so let dmext answer all fields at once
+            state = self._dmstate()
+            if state is not None and (state['branch'] == 'default' or state['default']):
+                result = {
+                    'revision': state['parent'] if state['branch'] == 'default'
+                                else state['default'],
+                    'dirty': state['dirty'],
+                    'source': state['path'] or '[local]',
+                }
+                result['active_branch'], result['branches'], needs_merge = \
+                    self._parse_bookmarks(self._dmstate_bookmarks(state))
+                result['divergent'] = list(needs_merge)
+                return {field: result[field] for field in fields}
+        return super(LocalHGRepo, self).snapshot(fields)
+
+    @cached
     def _bookmarks(self):
+        bookmarks = self._read_bookmarks()
+        if bookmarks is None:
+            # Without readable metadata, dmext's state is the next best thing
+            state = self._dmstate()
+            if state is not None:
+                bookmarks = self._dmstate_bookmarks(state)
+        if bookmarks is None:
+            bookmarks = []
+            output = call_hg('bookmark', pipe=True, cwd=self.root).rstrip().lstrip('\n')
+            if output == 'no bookmarks set':
+                output = ''
+            for line in output.split('\n'):
+                match = hg_bookmark_re.match(line)
+                if match:
+                    bookmarks.append(match.groups())
+        return self._parse_bookmarks(bookmarks)
+
+    def _parse_bookmarks(self, bookmarks):
         branches = {}
         needs_merge = {}
         active_branch = None
-        output = call_hg('bookmark', pipe=True, cwd=self.root).rstrip().lstrip('\n')
-        if output == 'no bookmarks set':
-            return active_branch, branches
-        for line in output.split('\n'):
-            match = hg_bookmark_re.match(line)
-            if not match:
-                continue
-            active, branch, revision = match.groups()
+        for active, branch, revision in bookmarks:
             name, divergent = self._get_real_bookmark_name(branch)
             if divergent:
                 if active:
@@ -187,11 +503,13 @@ class LocalHGRepo(LocalRepo):
     def branches(self):
         return self._bookmarks()[:2]
 
+    @modifies
     def create_branch(self, name):
         name = self.get_branch_name(name)
         return call_hg('bookmark', name, pipe=True, cwd=self.root).strip() or \
                'Created branch {}\n'.format(name)
 
+    @modifies
     def delete_branch(self, name):
         name = self.get_branch_name(name)
         output = call_hg('bookmark', '-d', name, pipe=True, cwd=self.root)
@@ -202,29 +520,61 @@ class LocalHGRepo(LocalRepo):
                 raise
         return output.strip()
 
-    def update(self, revision=None, date=None, clean=False):
+    @modifies
+    def update(self, revision=None, date=None, clean=False, resolved=None):
         if isinstance(revision, basestring):
             revision = (revision,)
         args = []
         if clean:
             args.append('-C')
-        if date:
+        if date and resolved:
+            args.append(resolved)
+        elif date:
             args.extend(['-d', '<' + date])
         elif not revision:
             pass
         elif len(revision) == 1:
             args.append(self.get_branch_name(revision[0]))
         else:
-            revnumbers = []
-            for rev in revision:
-                stdout = call_hg('log', '-r', rev, pipe=True, cwd=self.root)
-                revnumbers.append(int(hg_rev_re.search(stdout).group(1)))
-            latest = revision[revnumbers.index(max(revnumbers))]
-            args.append(latest)
+            args.append(self.latest_revision(revision))
         output = call_hg('update', *args, pipe=True, cwd=self.root)
         output = self._merge_if_needed(output)
         return output
 
+    def latest_revision(self, revisions):
+        revisions = [rev for index, rev in enumerate(revisions)
+                     if rev not in revisions[:index]]
+        # A single revset query returns the revision numbers in the given order
+        query = ' + '.join("'%s'" % rev for rev in revisions)
+        stdout = call_hg('log', '-r', query, '--template', '{rev}\n', pipe=True,
+                         cwd=self.root)
+        revnumbers = [int(rev) for rev in stdout.split()]
+        if len(revnumbers) == len(revisions):
+            return revisions[revnumbers.index(max(revnumbers))]
+        # Some of the revisions point to the same changeset, so the newest
+        # one has to be mapped back to the caller's name (e.g., a bookmark)
+        for rev in revisions:
+            stdout = call_hg('log', '-r', rev, '--template', '{rev}', pipe=True,
+                             cwd=self.root)
+            if int(stdout) == max(revnumbers):
+                return rev
+
+    def _checkout_revision(self):
+        # Like hg clone, prefer the @ bookmark over the default branch
+        return '@' if DEFAULT_BRANCH in self.branches()[1] else 'default'
+
+    @modifies
+    def checkout(self):
+        return call_hg('update', self._checkout_revision(), pipe=True, cwd=self.root)
+
+    def get_checkout_file(self, path):
+        try:
+            return call_hg('cat', '-r', self._checkout_revision(), path, pipe=True,
+                           cwd=self.root)
+        except ProcessError:
+            return None
+
+    @modifies
     def pull(self, merge=False):
         if self.get_source() == '[local]':
             return 'repository default not found!\n'
@@ -239,6 +589,7 @@ class LocalHGRepo(LocalRepo):
             return 'No changes found\n'
         return result
 
+    @modifies
     def fetch(self):
         return self.pull(merge=True)
 
@@ -250,6 +601,7 @@ class LocalHGRepo(LocalRepo):
             output = self.merge(output=output)
         return output
 
+    @modifies
     def merge(self, branch=None, output=''):
         try:
             args = []
@@ -267,6 +619,7 @@ class LocalHGRepo(LocalRepo):
                 raise ProcessError('%s\n%s' % (output, error.message))
         return output + 'Finished automatic merge\n'
 
+    @modifies
     def push(self):
         result = call_hg('push', pipe=True, cwd=self.root, max_status=1)
         if result.strip().endswith('no changes found'):
@@ -277,20 +630,28 @@ class LocalHGRepo(LocalRepo):
         return result
 
     def diff(self):
-        return call_hg('diff', pipe=True, cwd=self.path)
+        return call_hg('diff', spool=True, cwd=self.path)
 
     def status(self):
         return call_hg('status', pipe=True, cwd=self.path)
 
     def incoming(self):
-        result = call_hg('incoming', pipe=True, cwd=self.root, max_status=1)
+        result = call_hg('incoming', spool=True, cwd=self.root, max_status=1)
         return self._normalize_changesets(result)
 
     def outgoing(self):
-        result = call_hg('outgoing', pipe=True, cwd=self.root, max_status=1)
+        result = call_hg('outgoing', spool=True, cwd=self.root, max_status=1)
         return self._normalize_changesets(result)
 
     def _normalize_changesets(self, result):
+        if isinstance(result, SpooledOutput):
+            head = result.head(3)
+            if not result.is_blank_from(sum(map(len, head))):
+                # Return changesets without the two header lines
+                result.skip_lines(2)
+                result.rstrip = True
+                return result
+            result = ''.join(head)
         lines = result.rstrip().split('\n')
         if len(lines) < 3:
             # An error occured
@@ -302,6 +663,7 @@ class LocalHGRepo(LocalRepo):
             # Return changesets
             return '\n'.join(lines[2:]) + '\n'
 
+    @modifies
     def commit(self, message='', paths=None):
         if isinstance(paths, basestring):
             paths = (paths,)
@@ -315,23 +677,68 @@ class LocalHGRepo(LocalRepo):
             return ''
         return result
 
+    @modifies
     def addremove(self):
         return call_hg('addremove', '-s60', pipe=True, cwd=self.root)
 
+    @modifies
     def revert(self):
         return call_hg('revert', '--all', '--no-backup', pipe=True, cwd=self.root)
 
+    @modifies
     def record(self):
         return call_hg('record', cwd=self.root)
 
     def heads(self, divergent_only=True):
         if not divergent_only:
             return call_hg('heads', pipe=True, cwd=self.root)
-        needs_merge = self._bookmarks()[2]
-        if needs_merge:
-            return 'Needs merge: %s' % ', '.join(map(self.get_branch_name, needs_merge))
+        divergent = self.snapshot(('divergent',))['divergent']
+        if divergent:
+            return 'Needs merge: %s' % ', '.join(map(self.get_branch_name, divergent))
         return ''
 
+    def _read_sparse_includes(self):
+        # Returns None if the working copy isn't sparse
+        try:
+            with open(os.path.join(self.root, '.hg', 'sparse'), 'r') as fp:
+                lines = fp.read().splitlines()
+        except IOError:
+            return None
+        includes = []
+        section = None
+        for line in lines:
+            line = line.strip()
+            if line.startswith('['):
+                section = line
+            elif line and not line.startswith('#') and section == '[include]':
+                includes.append(line)
+        return includes or None
+
+    @modifies
+    def sparse_checkout(self, paths=None):
+        current = set(self._read_sparse_includes() or ())
+        if paths is None:
+            if not current:
+                return ''
+            return call_hg('debugsparse', '--reset', extensions=('sparse',),
+                           pipe=True, cwd=self.root)
+        wanted = {'path:%s' % path for path in paths}
+        if not current:
+            # All hg commands need the extension in a sparse working copy
+            set_hg_config(self.root, 'extensions', 'sparse', '')
+        output = ''
+        # Include new paths first, so the working copy never gets emptied
+        for option, patterns in (('--include', wanted - current),
+                                 ('--delete', current - wanted)):
+            if not patterns:
+                continue
+            args = []
+            for pattern in sorted(patterns):
+                args.extend([option, pattern])
+            output += call_hg('debugsparse', *args, extensions=('sparse',), pipe=True,
+                              cwd=self.root)
+        return output
+
 class RemoteGitRepo(RemoteRepo):
     def get_default_destination(self):
         destination = super(RemoteGitRepo, self).get_default_destination()
@@ -339,11 +746,48 @@ class RemoteGitRepo(RemoteRepo):
             return destination.rsplit('.', 1)[0]
         return destination
 
-    def clone(self, destination):
-        return call_git('clone', self.source, destination, pipe=True)
+    def clone(self, destination, depth=None, filter=None, checkout=True):
+        args = [] if checkout else ['--no-checkout']
+        mirror = get_mirror_path(self.source, 'git')
+        if mirror is None:
+            if depth:
+                # Shallow clones would only contain a single branch by default
+                args.extend(['--depth', str(depth), '--no-single-branch'])
+            if filter:
+                args.append('--filter=%s' % filter)
+            return call_git('clone', *(args + [self.source, destination]), pipe=True)
+        # Local clones of the full mirror are cheaper than shallow clones
+        with MirrorLock(mirror):
+            if os.path.exists(mirror):
+                output = call_git('fetch', '--prune', cwd=mirror, pipe=True)
+            else:
+                output = create_mirror(mirror, lambda path: call_git(
+                    'clone', '--mirror', self.source, path, pipe=True))
+            # Cloning from a local repo uses hardlinks
+            output += call_git('clone', *(args + [mirror, destination]), pipe=True)
+        output += call_git('remote', 'set-url', 'origin', self.source, cwd=destination,
+                           pipe=True)
+        return output
 
 class LocalGitRepo(LocalRepo):
+    def _metadata(self):
+        # Returns None if the repository can't be read without git
+        try:
+            return GitMetadata(self.root)
+        except (UnsupportedGitFormat, IOError, OSError):
+            return None
+
+    def get_config_path(self):
+        return os.path.join(self.root, '.git', 'config')
+
+    @cached
     def get_source(self):
+        metadata = self._metadata()
+        if metadata is not None:
+            source = metadata.get_remote_url('origin')
+            if source is None:
+                return '[local]'
+            return '[git]' + source
         data = StringIO()
         path = os.path.join(self.root, '.git', 'config')
         fp = open(path, 'r')
@@ -352,17 +796,82 @@ class LocalGitRepo(LocalRepo):
         data.seek(0)
         config = ConfigParser()
         config.readfp(data)
+        if not config.has_option('remote "origin"', 'url'):
+            return '[local]'
         source = config.get('remote "origin"', 'url')
         return '[git]' + source
 
-    def get_revision(self, no_uncommitted=True):
-        if no_uncommitted:
-            status = self.status()
-            if status.strip():
-                raise ValueError('Repository has uncommitted changes: %s' % self.root)
+    @cached
+    def _working_state(self):
+        # A single call returns both the revision and the changed files
+        status = call_git('status', '--porcelain=v2', '--branch', pipe=True,
+                          cwd=self.root)
+        revision = None
+        dirty = False
+        for line in status.strip().split('\n'):
+            if line.startswith('# branch.oid '):
+                revision = line.split(' ', 2)[2]
+            elif line and not line.startswith('#'):
+                dirty = True
+        if revision is None or revision == '(initial)':
+            revision = self._committed_revision()
+        return revision, dirty
+
+    @cached
+    def _committed_revision(self):
+        metadata = self._metadata()
+        if metadata is not None:
+            revision = metadata.head()[1]
+            if revision is not None:
+                return revision
         return call_git('rev-parse', 'HEAD', pipe=True, cwd=self.root).strip()
 
+    def get_commit_dates(self, entry=None):
+        # Index the history of HEAD in the order in which git log --before
+        # searches it
+        tip = call_git('rev-parse', '--verify', '-q', 'HEAD', pipe=True, cwd=self.root,
+                       max_status=1).strip() or None
+        if entry is not None and entry['tip'] == tip:
+            return entry
+        if tip is None:
+            return {'tip': None, 'linear': True, 'commits': []}
+        commits = None
+        log_range = tip
+        # git log sorts commits by date while walking the history, so the
+        # cached order can only be reused if the history has no merges
+        if entry is not None and entry['tip'] is not None and entry['linear']:
+            revisions = [revision for date, revision in entry['commits']]
+            if tip in revisions:
+                # HEAD was moved back (e.g., by update -d)
+                return {'tip': tip, 'linear': True,
+                        'commits': entry['commits'][revisions.index(tip):]}
+            commits = entry['commits']
+            log_range = '%s..%s' % (entry['tip'], tip)
+        stdout = call_git('log', '--format=%ct %H %P', log_range, pipe=True,
+                          cwd=self.root)
+        new_commits = []
+        linear = True
+        parent = None
+        for line in stdout.strip().split('\n'):
+            if not line:
+                continue
+            parts = line.split(' ')
+            if len(parts) > 3:
+                linear = False
+            new_commits.append([int(parts[0]), parts[1]])
+            parent = parts[2] if len(parts) > 2 else None
+        if commits is not None:
+            # The new commits must continue the cached history
+            if not linear or parent != entry['tip']:
+                return self.get_commit_dates()
+            new_commits += commits
+        return {'tip': tip, 'linear': linear, 'commits': new_commits}
+
+    @cached
     def default_branch(self):
+        metadata = self._metadata()
+        if metadata is not None:
+            return metadata.default_branch() or 'master'
         output = call_git('branch', '-r', pipe=True, cwd=self.root)
         for line in output.strip().split('\n'):
             match = git_default_branch_re.match(line)
@@ -371,7 +880,14 @@ class LocalGitRepo(LocalRepo):
             return match.group(1)
         return 'master'
 
+    @cached
     def _branches(self):
+        metadata = self._metadata()
+        if metadata is not None:
+            try:
+                return self._read_branches(metadata)
+            except (UnsupportedGitFormat, IOError, OSError):
+                pass
         branches = {}
         remote_branches = {}
         active_branch = None
@@ -396,12 +912,43 @@ class LocalGitRepo(LocalRepo):
             branches[branch] = revision
         return active_branch, branches, remote_branches
 
+    def _read_branches(self, metadata):
+        # Mirrors the output of "git branch -a -v" where remote branches come
+        # after local branches and thus take precedence
+        branches = {}
+        remote_branches = {}
+        default_branch = metadata.default_branch() or 'master'
+        packed = metadata.packed_refs()
+        active_branch = metadata.head()[0]
+        if active_branch == default_branch:
+            active_branch = DEFAULT_BRANCH
+        for ref, revision in sorted(metadata.refs('refs/heads/', packed).items()):
+            branch = ref[len('refs/heads/'):]
+            if branch == default_branch:
+                branch = DEFAULT_BRANCH
+            branches[branch] = revision
+        for ref, revision in sorted(metadata.refs('refs/remotes/', packed).items()):
+            parts = ref.split('/', 3)
+            if len(parts) < 4 or parts[3] == 'HEAD':
+                continue
+            branch = parts[3]
+            if branch == default_branch:
+                branch = DEFAULT_BRANCH
+            remote_branches[branch] = revision
+            branches[branch] = revision
+        return active_branch, branches, remote_branches
+
     def branches(self):
         active_branch, branches, remote_branches = self._branches()
         for branch, revision in remote_branches.items():
             branches.setdefault(branch, revision)
         return active_branch, branches
 
+    def _branch_state(self):
+        # Git branches can't diverge like hg bookmarks
+        return self.branches() + ([],)
+
+    @modifies
     def create_branch(self, name):
         # We have to check if there is a remote branch with this name before creating
         # a local one
@@ -413,6 +960,7 @@ class LocalGitRepo(LocalRepo):
             return ''
         return output
 
+    @modifies
     def delete_branch(self, name):
         remote = name in self._branches()[2]
         name = self.get_branch_name(name)
@@ -425,22 +973,27 @@ class LocalGitRepo(LocalRepo):
             return
         return output
 
-    def update(self, revision=None, date=None, clean=False):
+    @modifies
+    def update(self, revision=None, date=None, clean=False, resolved=None):
         if isinstance(revision, basestring):
             revision = (revision,)
         output = ''
-        if date:
+        if date and resolved:
+            revision = resolved
+        elif date:
             stdout = call_git('log', '-n', '1', '--before', date, pipe=True,
                               cwd=self.root)
+            # A shallow clone might not reach back far enough
+            if not stdout.strip() and self._deepen():
+                stdout = call_git('log', '-n', '1', '--before', date, pipe=True,
+                                  cwd=self.root)
             revision = stdout.split('\n', 1)[0].split(' ', 1)[1]
         elif revision and len(revision) == 1:
             # Before switching branches make sure we know all remote branches
             output += call_git('fetch', pipe=True, cwd=self.root)
             revision = self.get_branch_name(revision[0])
         elif revision:
-            stdout = call_git('rev-list', '--branches', pipe=True, cwd=self.root)
-            revlist = stdout.strip().split('\n')
-            revision = revlist[max(map(revlist.index, revision))]
+            revision = self.latest_revision(revision)
         else:
             # Checkout active branch
             revision = self.get_branch_name(self.branches()[0])
@@ -455,6 +1008,35 @@ class LocalGitRepo(LocalRepo):
             output += self.fetch()
         return output
 
+    def latest_revision(self, revisions):
+        # Without walking the history rev-list only sorts the given commits
+        # by date, newest first
+        args = ['rev-list', '--no-walk'] + list(revisions)
+        try:
+            stdout = call_git(*args, pipe=True, cwd=self.root)
+        except ProcessError:
+            # A shallow clone might not contain all of them
+            if not self._deepen():
+                raise
+            stdout = call_git(*args, pipe=True, cwd=self.root)
+        return stdout.split('\n', 1)[0].strip()
+
+    def _checkout_revision(self):
+        return self.get_branch_name(self.branches()[0]) or 'master'
+
+    @modifies
+    def checkout(self):
+        return call_git('checkout', '-f', self._checkout_revision(), pipe=True,
+                        cwd=self.root)
+
+    def get_checkout_file(self, path):
+        try:
+            return call_git('show', '%s:%s' % (self._checkout_revision(), path),
+                            pipe=True, cwd=self.root)
+        except ProcessError:
+            return None
+
+    @modifies
     def pull(self):
         try:
             result = call_git('pull', '--rebase', pipe=True, cwd=self.root)
@@ -468,12 +1050,14 @@ class LocalGitRepo(LocalRepo):
             return 'No changes found\n'
         return result
 
+    @modifies
     def fetch(self):
         result = self.pull()
         if not result or 'No changes found' in result:
             return result
         return self.merge(output=result)
 
+    @modifies
     def merge(self, branch=None, output=''):
         try:
             args = []
@@ -490,6 +1074,7 @@ class LocalGitRepo(LocalRepo):
             raise ProcessError('%s\n%s' % (output, error.message))
         return output + 'Finished automatic merge\n'
 
+    @modifies
     def push(self):
         result = call_git('push', '--all', '-u', pipe=True, cwd=self.root)
         if result.strip().endswith('Everything up-to-date'):
@@ -497,42 +1082,71 @@ class LocalGitRepo(LocalRepo):
         return result
 
     def diff(self):
-        return call_git('diff', pipe=True, cwd=self.path)
+        return call_git('diff', spool=True, cwd=self.path)
 
     def status(self):
         return call_git('status', '-s', pipe=True, cwd=self.path)
 
+    @modifies
     def incoming(self):
         call_git('fetch', pipe=True, cwd=self.root)
         active, branches, remote = self._branches()
-        output = []
+        output = SpooledOutput()
+        separator = ''
         for branch in branches:
             if branch not in remote:
                 continue
             branch = self.get_branch_name(branch)
-            output.append(call_git('log', '..origin/%s' % branch, pipe=True,
-                                   cwd=self.root))
-        return '\n\n'.join(output)
+            self._ensure_merge_base('origin/%s' % branch)
+            output.write(separator)
+            call_git('log', '..origin/%s' % branch, spool=output, cwd=self.root)
+            separator = '\n\n'
+        return output
 
+    @modifies
     def outgoing(self):
         call_git('fetch', pipe=True, cwd=self.root)
         active, branches, remote = self._branches()
-        output = []
+        output = SpooledOutput()
+        separator = ''
         for branch in branches:
+            output.write(separator)
+            separator = '\n\n'
             if branch not in remote:
-                output.append('New branch %s\n' % self.get_branch_name(branch))
+                output.write('New branch %s\n' % self.get_branch_name(branch))
                 continue
             branch = self.get_branch_name(branch)
-            output.append(call_git('log', 'origin/%s..' % branch, pipe=True,
-                                   cwd=self.root))
-        return '\n\n'.join(output)
+            self._ensure_merge_base('origin/%s' % branch)
+            call_git('log', 'origin/%s..' % branch, spool=output, cwd=self.root)
+        return output
 
+    def _is_shallow(self):
+        return os.path.exists(os.path.join(self.root, '.git', 'shallow'))
+
+    def _deepen(self):
+        # Fetches the history which is missing in a shallow clone. Returns
+        # whether anything had to be fetched.
+        if not self._is_shallow():
+            return False
+        call_git('fetch', '--unshallow', pipe=True, cwd=self.root)
+        return True
+
+    def _ensure_merge_base(self, revision):
+        # Without the merge base log would list all commits of a shallow clone
+        if self._is_shallow() and not call_git(
+                'merge-base', 'HEAD', revision, max_status=1, pipe=True,
+                cwd=self.root).strip():
+            self._deepen()
+
+    @modifies
     def addremove(self):
         return call_git('add', '-A', pipe=True, cwd=self.root)
 
+    @modifies
     def revert(self):
         return call_git('reset', '--hard', pipe=True, cwd=self.root)
 
+    @modifies
     def record(self):
         has_changes = bool(call_git('status', '-s', '--untracked-files=no',
                                     pipe=True, cwd=self.path).strip())
@@ -541,6 +1155,7 @@ class LocalGitRepo(LocalRepo):
             return
         return call_git('commit', '-p', cwd=self.root)
 
+    @modifies
     def commit(self, message='', paths=None):
         has_changes = bool(call_git('status', '-s', '--untracked-files=no',
                                     pipe=True, cwd=self.path).strip())
@@ -561,6 +1176,35 @@ class LocalGitRepo(LocalRepo):
         # TODO: Git doesn't have a heads command, so let's ignore it for now
         return ''
 
+    @modifies
+    def sparse_checkout(self, paths=None):
+        sparse_path = os.path.join(self.root, '.git', 'info', 'sparse-checkout')
+        try:
+            with open(sparse_path, 'r') as fp:
+                current = fp.read().splitlines()
+        except IOError:
+            current = None
+        if paths is None:
+            if current is None:
+                return ''
+            patterns = ['/*']
+        else:
+            patterns = ['/%s' % path for path in paths]
+            if patterns == current:
+                return ''
+        if not os.path.isdir(os.path.dirname(sparse_path)):
+            os.makedirs(os.path.dirname(sparse_path))
+        with open(sparse_path, 'w') as fp:
+            fp.write(''.join(pattern + '\n' for pattern in patterns))
+        output = call_git('config', 'core.sparseCheckout', 'true', pipe=True,
+                          cwd=self.root)
+        output += call_git('read-tree', '-mu', 'HEAD', pipe=True, cwd=self.root)
+        if paths is None:
+            output += call_git('config', 'core.sparseCheckout', 'false', pipe=True,
+                               cwd=self.root)
+            os.remove(sparse_path)
+        return output
+
 REMOTE_REPOS = {
     'hg': RemoteHGRepo,
     'git': RemoteGitRepo,
@@ -569,6 +1213,21 @@ REMOTE_REPOS = {
 
 repo_type_re = re.compile(r'^\[(\w+)\](.*)$', re.UNICODE)
 
+scp_source_re = re.compile(r'^(?:[^@/:]+@)?([^/:]+):(?!//)', re.UNICODE)
+
+def get_source_host(source):
+    # Returns the remote host of the given source URL or None for local sources
+    match = repo_type_re.match(source)
+    if match:
+        source = match.group(2)
+    if '://' in source:
+        return urlparse(source).hostname
+    match = scp_source_re.match(source)
+    # Ignore Windows paths like C:\path
+    if match and len(match.group(1)) > 1:
+        return match.group(1).lower()
+    return None
+
 def get_remote_repo(source):
     repo_type = 'hg'
     match = repo_type_re.match(source)
@@ -611,47 +1270,221 @@ def detect_local_repo(root):
 class ProcessError(Exception):
     pass
 
+# Additional environment variables and hg --config options for all calls
+CALL_ENV = {}
+HG_CONFIG = {}
+
+def set_ssh_command(git_ssh, hg_ssh):
+    CALL_ENV['GIT_SSH_COMMAND'] = git_ssh
+    HG_CONFIG['ui.ssh'] = hg_ssh
+
+def get_call_env(pipe=False):
+    env = dict(os.environ, LANG='en-us')
+    env.update(CALL_ENV)
+    if pipe:
+        env['NOPROMPT'] = 'True'
+    return env
+
+def check_call_result(run, status, result, max_status=0, pipe=False, start=None):
+    if isinstance(result, SpooledOutput):
+        # Errors are reported at the end of the output. Output of earlier
+        # calls (before start) which got appended to the same spool is skipped.
+        result = result.tail(start=start)
+    has_error = pipe and 'connection closed by remote host' in result.lower()
+
+    if status < 0 or status > max_status or has_error:
+        message = '!!!!!!!!!!!!!!!!!!!!!!!!!\n' \
+                  'Error while calling {}. Aborting (status {}).\nRan: {}\n'.format(
+                    run[0], status, run)
+        if pipe:
+            raise ProcessError(message + result)
+        sys.stderr.write(message)
+        sys.exit(1)
+
+def raise_timeout(run, timeout, result='', start=None):
+    if isinstance(result, SpooledOutput):
+        result = result.tail(start=start)
+    raise ProcessError('!!!!!!!!!!!!!!!!!!!!!!!!!\n'
+                       'Timed out after {} seconds while calling {}. Aborting.\n'
+                       'Ran: {}\n{}'.format(timeout, run[0], run, result or ''))
+
+def get_call_name(run):
+    # E.g., "hg pull" for hg --config ui.foo=bar pull
+    params = list(run[1:])
+    while len(params) > 1 and params[0] in ('--config', '-c'):
+        del params[:2]
+    return ' '.join(run[:1] + tuple(params[:1]))
+
 def clean_call(*run, **kwargs):
     max_status = kwargs.pop('max_status', 0)
     pipe = kwargs.pop('pipe', False)
+    # If spool is True (or a SpooledOutput to append to) the output is
+    # returned as a SpooledOutput instead of a string
+    spool = kwargs.pop('spool', None)
+    pipe = pipe or spool is not None
     result = None
+    start = None
 
-    env = dict(os.environ, LANG='en-us')
+    env = get_call_env(pipe)
 
     if pipe:
         kwargs.setdefault('universal_newlines', True)
         kwargs.setdefault('stdout', PIPE)
         kwargs.setdefault('stderr', STDOUT)
-        env['NOPROMPT'] = 'True'
 
     if env != os.environ:
         kwargs.setdefault('env', env)
 
-    process = Popen(run, **kwargs)
+    # Interactive calls never time out
+    timeout = get_timeout() if pipe else None
+    with span(get_call_name(run), 'call', repo=kwargs.get('cwd'),
+              argv=list(run)) as trace_args:
+        process = start_process(run, new_group=timeout is not None, **kwargs)
+        watchdog = Watchdog(process, timeout) if timeout is not None else None
 
-    if pipe:
-        result = process.communicate()[0]
-
-    status = process.wait()
-    has_error = pipe and 'connection closed by remote host' in result.lower()
+        try:
+            if spool is not None:
+                result = spool if isinstance(spool, SpooledOutput) else SpooledOutput()
+                start = result.size
+                for data in iter(lambda: process.stdout.read(CHUNK_SIZE), ''):
+                    result.write(data)
+            elif pipe:
+                result = process.communicate()[0]
+
+            status = trace_args['status'] = process.wait()
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            finish_process(process)
 
-    if status < 0 or status > max_status or has_error:
-        message = '!!!!!!!!!!!!!!!!!!!!!!!!!\n' \
-                  'Error while calling {}. Aborting (status {}).\nRan: {}\n'.format(
-                    run[0], status, run)
-        if pipe:
-            raise ProcessError(message + result)
-        sys.stderr.write(message)
-        sys.exit(1)
+        if watchdog is not None and watchdog.expired:
+            trace_args['timed_out'] = True
+            raise_timeout(run, timeout, result, start)
+    check_call_result(run, status, result, max_status, pipe, start)
 
     if not pipe:
         sys.stdout.write('\n')
 
     return result
 
+# When enabled, hg commands are sent to one persistent command server per
+# working directory instead of forking a new hg process for every call
+HG_CMDSERVER = False
+hg_servers = {}
+hg_servers_lock = Lock()
+# Per-repo locks which are held while the repo's server starts
+hg_server_locks = {}
+
+def enable_hg_cmdserver(enabled=True):
+    global HG_CMDSERVER
+    HG_CMDSERVER = enabled
+
+def get_hg_server(cwd):
+    cwd = os.path.abspath(cwd)
+    with hg_servers_lock:
+        if cwd in hg_servers:
+            return hg_servers[cwd]
+        lock = hg_server_locks.setdefault(cwd, Lock())
+    # Only calls for the same repo wait for the server's startup, so the
+    # servers of different repos get started in parallel
+    with lock:
+        with hg_servers_lock:
+            if cwd in hg_servers:
+                return hg_servers[cwd]
+        try:
+            # With timeouts the server might have to be killed together
+            # with its children
+            server = CommandServer(cwd, get_call_env(pipe=True),
+                                   new_group=bool(TIMEOUTS))
+        except (OSError, CommandServerError):
+            # Fall back to forking if the command server isn't available
+            server = None
+        with hg_servers_lock:
+            hg_servers[cwd] = server
+        return server
+
+def close_hg_servers():
+    with hg_servers_lock:
+        servers = hg_servers.values()
+        hg_servers.clear()
+    for server in servers:
+        if server is not None:
+            server.close()
+
+def close_idle_hg_servers():
+    # Busy servers get killed together with the other running processes
+    with hg_servers_lock:
+        for cwd, server in hg_servers.items():
+            if server is not None and server.close_if_idle():
+                del hg_servers[cwd]
+
+def call_hg_server(server, *params, **kwargs):
+    run = ('hg',) + params
+    spool = kwargs.get('spool')
+    if spool is not None and not isinstance(spool, SpooledOutput):
+        spool = SpooledOutput()
+    start = spool.size if spool is not None else None
+    # A timed out command can only be stopped by killing the whole server
+    timeout = get_timeout()
+    watchdog = Watchdog(server.process, timeout) if timeout is not None else None
+    with span(get_call_name(run), 'call', repo=server.cwd, argv=list(run),
+              cmdserver=True) as trace_args:
+        try:
+            status, result = server.runcommand(params, spool)
+        except CommandServerError as error:
+            status, result = None, error
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+        trace_args['status'] = status
+    if status is None or (watchdog is not None and watchdog.expired):
+        # The server is dead or about to die
+        with hg_servers_lock:
+            hg_servers[server.cwd] = None
+        server.close()
+        if watchdog is not None and watchdog.expired:
+            raise_timeout(run, timeout, spool, start)
+        raise ProcessError('!!!!!!!!!!!!!!!!!!!!!!!!!\n%s\nRan: %s\n' % (result, run))
+    if spool is None:
+        result = result.replace('\r\n', '\n')
+    check_call_result(run, status, result, kwargs.get('max_status', 0), pipe=True,
+                      start=start)
+    return result
+
+def filter_hg_line(line):
+    # Returns the line with normalized newlines or None if it's an extension
+    # warning, which gets moved to stderr
+    if line.startswith('*** failed to import extension'):
+        sys.stderr.write(line)
+        return None
+    return line.replace('\r\n', '\n')
+
 def call_hg(*params, **kwargs):
-    result = clean_call(*(['hg'] + list(params)), **kwargs)
-    if kwargs.get('pipe'):
+    options = []
+    for name, value in sorted(HG_CONFIG.items()):
+        options.extend(['--config', '%s=%s' % (name, value)])
+    # Extensions can't be enabled per command in a command server
+    extensions = kwargs.pop('extensions', ())
+    for name in extensions:
+        options.extend(['--config', 'extensions.%s=' % name])
+    params = tuple(options) + params
+    spool = kwargs.get('spool')
+    if spool is not None and not isinstance(spool, SpooledOutput):
+        spool = kwargs['spool'] = SpooledOutput()
+    start = spool.size if spool is not None else None
+    server = None
+    use_server = HG_CMDSERVER and not extensions and kwargs.get('cwd') and \
+        (kwargs.get('pipe') or spool is not None) and \
+        set(kwargs) <= {'pipe', 'spool', 'cwd', 'max_status'}
+    if use_server:
+        server = get_hg_server(kwargs['cwd'])
+    if server is not None:
+        result = call_hg_server(server, *params, **kwargs)
+    else:
+        result = clean_call(*(['hg'] + list(params)), **kwargs)
+    if spool is not None:
+        result.filter_lines(filter_hg_line, start)
+    elif kwargs.get('pipe'):
         lines = result.split('\n')
         for line in lines[:]:
             if line.startswith('*** failed to import extension'):
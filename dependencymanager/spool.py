@@ -0,0 +1,114 @@
+from tempfile import SpooledTemporaryFile
+
+# Output which exceeds this size (in bytes) gets moved to a temporary file
+SPOOL_THRESHOLD = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+def set_spool_threshold(threshold):
+    global SPOOL_THRESHOLD
+    SPOOL_THRESHOLD = threshold
+
+class SpooledOutput(object):
+    """
+    Collects command output in memory until it gets too big and then
+    continues in a temporary file, so huge diffs and logs don't have to be
+    kept in memory. Use write_to() to stream the output somewhere.
+    """
+    def __init__(self):
+        self.file = SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+        self.size = 0
+        self.blank = True
+        # Number of bytes to skip at the beginning (see skip_lines())
+        self.start = 0
+        # Replace trailing whitespace with a single newline when writing
+        self.rstrip = False
+
+    def __nonzero__(self):
+        # Just like with strings, whitespace-only output counts as no output
+        return not self.blank
+
+    def write(self, data):
+        self.file.seek(0, 2)
+        self.file.write(data)
+        self.size += len(data)
+        if self.blank and data.strip():
+            self.blank = False
+
+    def chunks(self, start=None):
+        self.file.seek(self.start if start is None else start)
+        while True:
+            data = self.file.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+    def head(self, count):
+        """Returns the first count lines."""
+        self.file.seek(0)
+        lines = []
+        for _ in range(count):
+            line = self.file.readline()
+            if not line:
+                break
+            lines.append(line)
+        return lines
+
+    def is_blank_from(self, start):
+        return not any(chunk.strip() for chunk in self.chunks(start))
+
+    def skip_lines(self, count):
+        self.start = sum(map(len, self.head(count)))
+
+    def write_to(self, stream):
+        pending = ''
+        for chunk in self.chunks():
+            if self.rstrip:
+                chunk = pending + chunk
+                stripped = chunk.rstrip()
+                pending = chunk[len(stripped):]
+                chunk = stripped
+            stream.write(chunk)
+        if self.rstrip:
+            stream.write('\n')
+
+    def filter_lines(self, func, start=0):
+        """
+        Replaces each line after the start offset with func(line). Lines for
+        which func returns None are removed.
+        """
+        output = SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+        self.file.seek(0)
+        output.write(self.file.read(start))
+        changed = False
+        for line in iter(self.file.readline, ''):
+            filtered = func(line)
+            if filtered != line:
+                changed = True
+            if filtered:
+                output.write(filtered)
+        if not changed:
+            # Nothing to do, so keep the original file
+            output.close()
+            return
+        self.file.close()
+        self.file = output
+        self.size = output.tell()
+        self.blank = self.is_blank_from(0)
+
+    def tail(self, size=None, start=None):
+        """
+        Returns (at most) the last size bytes of the output (or the output
+        after the start offset) as a string.
+        """
+        if size is None:
+            size = SPOOL_THRESHOLD
+        if start is None or start < self.start:
+            start = self.start
+        self.file.seek(max(start, self.size - size))
+        data = self.file.read()
+        if self.size - start > size:
+            data = '[...output truncated...]\n' + data
+        return data
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,33 @@
+from pipes import quote
+from subprocess import call
+import os
+import shutil
+import tempfile
+
+class SSHMultiplexer(object):
+    """
+    Makes all ssh connections of a dm command share one master connection
+    per host, so only the first connection has to do the ssh handshake.
+    """
+    def __init__(self, persist=120):
+        # Keep the path short because unix socket paths are limited in length
+        self.directory = tempfile.mkdtemp(prefix='dm-ssh-')
+        self.options = [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % os.path.join(self.directory, '%C'),
+            # Masters are stopped in close(). The timeout only makes sure they
+            # also go away if dm gets killed.
+            '-o', 'ControlPersist=%d' % persist,
+        ]
+
+    def get_ssh_command(self, base='ssh'):
+        return ' '.join([base] + [quote(option) for option in self.options])
+
+    def close(self):
+        with open(os.devnull, 'w') as devnull:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                # The host name doesn't matter because the socket path is given
+                call(['ssh', '-o', 'ControlPath=%s' % path, '-O', 'exit', 'dm'],
+                     stdout=devnull, stderr=devnull)
+        shutil.rmtree(self.directory, ignore_errors=True)
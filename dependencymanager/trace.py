@@ -0,0 +1,75 @@
+from contextlib import contextmanager
+from threading import Lock, current_thread
+import json
+import os
+import time
+
+# Path of the Chrome trace-event JSON file (None if tracing is disabled)
+TRACE_FILE = None
+trace_name = 'dm'
+trace_start = time.time()
+events = []
+events_lock = Lock()
+
+def enable_trace(path, name='dm'):
+    global TRACE_FILE, trace_start, trace_name
+    TRACE_FILE = path
+    trace_name = name
+    trace_start = time.time()
+
+def get_timestamp(now=None):
+    # Trace viewers expect microseconds
+    return int(((now or time.time()) - trace_start) * 1000000)
+
+def add_event(name, category, start, end, args=None, thread=None):
+    thread = thread or current_thread()
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': get_timestamp(start),
+        'dur': get_timestamp(end) - get_timestamp(start),
+        'pid': os.getpid(),
+        'tid': thread.ident,
+        'args': args or {},
+    }
+    with events_lock:
+        events.append((thread.name, event))
+
+@contextmanager
+def span(name, category, **args):
+    """
+    Records the time spent in the with block. Yields the event's args, so
+    results (e.g., the exit status) can be added to them.
+    """
+    if TRACE_FILE is None:
+        yield args
+        return
+    start = time.time()
+    try:
+        yield args
+    finally:
+        add_event(name, category, start, time.time(), args)
+
+def traced(func, name, category, **args):
+    def wrapper(*func_args, **func_kwargs):
+        with span(name, category, **args):
+            return func(*func_args, **func_kwargs)
+    return wrapper
+
+def write_trace():
+    if TRACE_FILE is None:
+        return
+    add_event(trace_name, 'dm', trace_start, time.time())
+    with events_lock:
+        recorded = list(events)
+    trace_events = []
+    threads = {}
+    for thread_name, event in recorded:
+        threads[event['tid']] = thread_name
+        trace_events.append(event)
+    for tid, thread_name in threads.items():
+        trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                             'tid': tid, 'args': {'name': thread_name}})
+    with open(TRACE_FILE, 'w') as fp:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, fp)
@@ -1,5 +1,8 @@
 from .repo import ProcessError
-from threading import Thread
+from Queue import Queue, Empty
+from collections import deque
+from threading import Event, Lock, Thread
+import multiprocessing
 # Use the system PRNG if possible
 import hashlib, random, time
 try:
@@ -32,26 +35,215 @@ def get_secure_random_string(*args, **kwargs):
                                    (random.getstate(), time.time(), __file__)).digest())
     return get_random_string(*args, **kwargs)
 
-class AsyncResult(object):
-    def __init__(self, func, args=(), kwargs=None):
+class CancelledError(Exception):
+    pass
+
+class Task(object):
+    def __init__(self, func, args=(), kwargs=None, group=None):
         if kwargs is None:
             kwargs = {}
         self.func = func
-        self.thread = Thread(target=self.run, args=args, kwargs=kwargs)
-        self.thread.start()
+        self.args = args
+        self.kwargs = kwargs
+        self.group = group
+        self.started = None
+        self.error = None
+        self.finished = Event()
+        self.callbacks = []
+        self.callbacks_lock = Lock()
 
-    def run(self, *args, **kwargs):
+    def run(self):
+        self.started = time.time()
         try:
-            self.result = self.func(*args, **kwargs)
+            self.result = self.func(*self.args, **self.kwargs)
         except ProcessError as e:
             self.result = e
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.finish()
+
+    def cancel(self):
+        # Finishes a task which hasn't been started, so nobody waits for it forever
+        self.result = None
+        self.error = CancelledError('Cancelled before it was started')
+        self.finish()
+
+    def finish(self):
+        with self.callbacks_lock:
+            self.finished.set()
+            callbacks = self.callbacks[:]
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self.callbacks_lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self.finished.is_set()
 
     def do(self):
-        self.thread.join()
+        # Waiting with a timeout keeps the main thread responsive to Ctrl-C
+        while not self.finished.wait(0.2):
+            pass
+        if self.error is not None:
+            raise self.error
         return self.result
 
-def with_lock(func, lock):
-    def wrapper(*args, **kwargs):
-        with lock:
-            return func(*args, **kwargs)
-    return wrapper
+def as_completed(tasks, on_wait=None, interval=0.2):
+    """
+    Yields the given tasks as soon as they're finished. While waiting,
+    on_wait() gets called every interval seconds (e.g., to show progress).
+    """
+    finished = Queue()
+    for task in tasks:
+        task.add_done_callback(finished.put)
+    for _ in range(len(tasks)):
+        while True:
+            try:
+                # Waiting with a timeout keeps the main thread responsive to Ctrl-C
+                yield finished.get(timeout=interval)
+                break
+            except Empty:
+                if on_wait is not None:
+                    on_wait()
+
+class ProgressLine(object):
+    """Shows a single, continuously overwritten status line on a terminal."""
+    def __init__(self, stream, width=79):
+        self.stream = stream
+        self.width = width
+        self.length = 0
+
+    def show(self, text):
+        text = text[:self.width]
+        self.stream.write('\r%s%s' % (text, ' ' * max(0, self.length - len(text))))
+        self.stream.flush()
+        self.length = len(text)
+
+    def clear(self):
+        if self.length:
+            self.stream.write('\r%s\r' % (' ' * self.length))
+            self.stream.flush()
+            self.length = 0
+
+def positive_int(value):
+    # Job limits of 0 or less would hang dm or disable the limit
+    value = int(value)
+    if value <= 0:
+        raise ValueError('%d is not a positive number' % value)
+    return value
+
+def get_default_jobs():
+    # Most of the work happens in hg/git processes which are partly CPU-bound
+    # (startup) and partly I/O-bound (network, disk)
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 2
+    return max(4, min(32, cpus * 2))
+
+class Executor(object):
+    """
+    Runs tasks on a bounded pool of worker threads.
+
+    Tasks can be assigned to a group (e.g., the remote host) and at most
+    group_limit tasks of the same group run at the same time. This limit can
+    be overridden per group via group_limits.
+    """
+    def __init__(self, jobs=None, group_limit=None, group_limits=None):
+        self.jobs = jobs or get_default_jobs()
+        self.group_limit = group_limit
+        self.group_limits = group_limits or {}
+        self.queue = Queue()
+        self.workers = []
+        self.running = {}
+        self.pending = {}
+        self.lock = Lock()
+
+    def get_group_limit(self, group):
+        return self.group_limits.get(group, self.group_limit)
+
+    def submit(self, func, args=(), kwargs=None, group=None):
+        task = Task(func, args, kwargs, group)
+        with self.lock:
+            if len(self.workers) < self.jobs:
+                worker = Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            limit = self.get_group_limit(group)
+            if group is not None and limit:
+                if self.running.get(group, 0) >= limit:
+                    self.pending.setdefault(group, deque()).append(task)
+                    return task
+                self.running[group] = self.running.get(group, 0) + 1
+        self.queue.put(task)
+        return task
+
+    def release(self, task):
+        with self.lock:
+            if task.group not in self.running:
+                return
+            pending = self.pending.get(task.group)
+            if pending:
+                # The freed slot goes directly to the next task of this group
+                self.queue.put(pending.popleft())
+            else:
+                self.running[task.group] -= 1
+
+    def cancel(self):
+        # Drops all tasks which haven't been started, yet
+        with self.lock:
+            tasks = [task for pending in self.pending.values() for task in pending]
+            self.pending.clear()
+            sentinels = 0
+            while True:
+                try:
+                    task = self.queue.get_nowait()
+                except Empty:
+                    break
+                if task is None:
+                    sentinels += 1
+                    continue
+                tasks.append(task)
+                # Queued tasks already occupy a slot of their group
+                if task.group in self.running:
+                    self.running[task.group] -= 1
+            # Workers which are about to be shut down still need their sentinel
+            for _ in range(sentinels):
+                self.queue.put(None)
+        for task in tasks:
+            task.cancel()
+
+    def shutdown(self, timeout=None):
+        # Stops the workers as soon as they've finished their current task
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for _ in workers:
+            self.queue.put(None)
+        for worker in workers:
+            worker.join(timeout)
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            task.run()
+            self.release(task)
+
+executor = None
+
+def set_jobs(jobs, host_limit=None, host_limits=None):
+    global executor
+    executor = Executor(jobs, host_limit, host_limits)
+
+def get_executor():
+    if executor is None:
+        set_jobs(None)
+    return executor
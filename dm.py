@@ -2,8 +2,10 @@
 from dependencymanager.core import (clone_cmd, build_cmd, fetch_cmd, push_cmd,
     pull_cmd, status_cmd, diff_cmd, incoming_cmd, outgoing_cmd, deploy_cmd,
     revspec_cmd, tag_cmd, tags_cmd, update_cmd, addremove_cmd, record_cmd,
-    commit_cmd, heads_cmd, branch_cmd, merge_cmd, publish_cmd, revert_cmd)
+    commit_cmd, heads_cmd, branch_cmd, merge_cmd, publish_cmd, revert_cmd,
+    configure, shutdown)
 from dependencymanager.repo import find_local_repo
+from dependencymanager.utils import positive_int
 from subprocess import call
 import argparse
 import os
@@ -46,6 +48,25 @@ def main():
                                      usage='dm [options]')
     parser.add_argument('--no-update-check', action='store_true',
                         help="don't check for updates on pull/fetch/clone")
+    parser.add_argument('-j', '--jobs', type=positive_int, metavar='N',
+                        help='number of repositories to process in parallel')
+    parser.add_argument('--max-per-host', type=positive_int, metavar='N',
+                        help='maximum number of parallel network operations per host')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='abort repository operations which take longer')
+    parser.add_argument('--stream', action='store_true',
+                        help='print results in the order in which repos finish')
+    parser.add_argument('--summary', action='store_true',
+                        help='print a sorted summary after streamed results')
+    parser.add_argument('--pager', action='store_true',
+                        help='show the output of repository commands in a pager')
+    parser.add_argument('--ssh-multiplex', action='store_true',
+                        help='share one ssh connection per host between all calls')
+    parser.add_argument('--hg-cmdserver', action='store_true',
+                        help='run hg commands through persistent command servers')
+    parser.add_argument('--trace', metavar='FILE', default=os.environ.get('DM_TRACE'),
+                        help='write a Chrome trace of all commands run by dm to FILE '
+                             '(default: $DM_TRACE)')
 
     repo_parser = argparse.ArgumentParser(add_help=False)
     repo_parser.add_argument('repo', nargs='*',
@@ -70,6 +91,9 @@ def main():
     help = 'rebuild the project after a .dmrc was changed'
     subparser = subparsers.add_parser('build', add_help=False,
                                       help=help, description=help)
+    subparser.add_argument('--rescan', action='store_true',
+                           help='search the whole project for existing links instead '
+                                'of trusting the links recorded by the last build')
     subparser.set_defaults(func=build_cmd)
 
     for name in ('pu', 'pull'):
@@ -218,7 +242,14 @@ def main():
         run = [sys.executable, sys.argv[0], '--no-update-check'] + sys.argv[1:]
         call(run)
         return
-    args.func(args)
+    configure(args)
+    try:
+        args.func(args)
+    except KeyboardInterrupt:
+        sys.stderr.write('\nInterrupted\n')
+        sys.exit(1)
+    finally:
+        shutdown()
 
 if __name__ == '__main__':
     main()
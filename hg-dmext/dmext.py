@@ -1,6 +1,6 @@
-from mercurial import cmdutil, commands, ui, localrepo
+from mercurial import cmdutil, commands, config, error, ui, localrepo
 from mercurial.node import hex, short
-import os, sys
+import json, os, sys
 
 cmdtable = {}
 command = cmdutil.command(cmdtable)
@@ -70,6 +70,36 @@ def dmmerge(ui, repo, branch, **kwargs):
         name = '@'
     cmdutil.findcmd('merge', commands.table)[1][0](ui, repo, name, **kwargs)
 
+def get_local_path(repo, name='default'):
+    # Like dm, only look at the repo's own hgrc and not at the user's config
+    hgrc = config.config()
+    path = os.path.join(repo.path, 'hgrc')
+    if os.path.exists(path):
+        hgrc.read(path)
+    return hgrc.get('paths', name)
+
+@command('dmstate')
+def dmstate(ui, repo, **kwargs):
+    # Returns everything dm needs to know about the repo with a single call
+    wctx = repo[None]
+    bookmarks = dict((mark, short(node)) for mark, node in repo._bookmarks.items())
+    try:
+        default = short(repo.lookup('default'))
+    except error.RepoLookupError:
+        default = None
+    state = {
+        'bookmarks': bookmarks,
+        'active': repo._activebookmark,
+        'divergent': sorted(mark for mark in bookmarks
+                            if '@' in mark and mark.split('@', 1)[1]),
+        'parent': short(repo['.'].node()),
+        'branch': wctx.branch(),
+        'default': default,
+        'dirty': bool(wctx.dirty(missing=True)),
+        'path': get_local_path(repo),
+    }
+    ui.write(json.dumps(state) + '\n')
+
 if os.environ.get('NOPROMPT') == 'True':
     def get_input(prompt, is_password=False):
         if is_password:
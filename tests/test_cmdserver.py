@@ -0,0 +1,48 @@
+from dependencymanager import repo
+from threading import Thread
+import time
+import unittest
+
+class SlowServer(object):
+    started = []
+
+    def __init__(self, cwd, env, new_group=False):
+        time.sleep(0.3)
+        self.cwd = cwd
+        SlowServer.started.append(cwd)
+
+    def close(self):
+        pass
+
+class HGServerTest(unittest.TestCase):
+    def setUp(self):
+        self.command_server = repo.CommandServer
+        repo.CommandServer = SlowServer
+        SlowServer.started = []
+
+    def tearDown(self):
+        repo.CommandServer = self.command_server
+        repo.close_hg_servers()
+        repo.hg_server_locks.clear()
+
+    def start(self, paths):
+        threads = [Thread(target=repo.get_hg_server, args=(path,)) for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_parallel_startup(self):
+        start = time.time()
+        self.start(['/repo%d' % index for index in range(8)])
+        self.assertEqual(len(SlowServer.started), 8)
+        # The servers of different repos don't wait for each other
+        self.assertTrue(time.time() - start < 1.2)
+
+    def test_one_server_per_repo(self):
+        self.start(['/repo'] * 4)
+        self.assertEqual(SlowServer.started, ['/repo'])
+        self.assertTrue(isinstance(repo.get_hg_server('/repo'), SlowServer))
+
+if __name__ == '__main__':
+    unittest.main()
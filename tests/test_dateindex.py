@@ -0,0 +1,139 @@
+from dependencymanager.dateindex import DateIndex, parse_date
+from dependencymanager.repo import LocalGitRepo
+from subprocess import PIPE, Popen
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+BASE = 1577836800
+
+class ParseDateTest(unittest.TestCase):
+    def test_full_dates(self):
+        expected = time.mktime((2020, 1, 2, 3, 4, 5, 0, 0, -1))
+        self.assertEqual(parse_date('2020-01-02 03:04:05'), expected)
+        self.assertEqual(parse_date(' 2020-01-02T03:04:05 '), expected)
+
+    def test_other_formats(self):
+        # git and hg interpret these differently, so they resolve them themselves
+        self.assertEqual(parse_date('2020-01-02'), None)
+        self.assertEqual(parse_date('2020-01-02 03:04'), None)
+        self.assertEqual(parse_date('yesterday'), None)
+
+class DateIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_find(self):
+        index = DateIndex(self.root)
+        # Like with git log, a commit can be older than its successor
+        index.repos['repo'] = {'commits': [[30, 'c'], [10, 'b'], [20, 'a']]}
+        self.assertEqual(index.find('repo', 40), 'c')
+        self.assertEqual(index.find('repo', 25), 'b')
+        self.assertEqual(index.find('repo', 10), 'b')
+        self.assertEqual(index.find('repo', 5), None)
+        self.assertEqual(index.find('other', 40), None)
+
+    def test_save(self):
+        index = DateIndex(self.root)
+        index.repos['repo'] = {'tip': 'c', 'commits': [[30, 'c']]}
+        index.save()
+        self.assertEqual(DateIndex.load(self.root).repos, index.repos)
+
+class GitCommitDatesTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.repo = LocalGitRepo(self.root)
+        self.git('init', '-q')
+        self.git('checkout', '-q', '-b', 'main')
+        self.commit(100)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def git(self, *args, **env):
+        env = dict(os.environ, GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@t',
+                   GIT_COMMITTER_NAME='t', GIT_COMMITTER_EMAIL='t@t', **env)
+        process = Popen(('git',) + args, cwd=self.root, env=env, stdout=PIPE)
+        stdout = process.communicate()[0].decode('ascii').strip()
+        self.assertEqual(process.returncode, 0)
+        return stdout
+
+    def commit(self, offset):
+        date = '%d +0000' % (BASE + offset)
+        self.git('commit', '-q', '--allow-empty', '-m', str(offset),
+                 GIT_COMMITTER_DATE=date, GIT_AUTHOR_DATE=date)
+
+    def merge(self, branch, offset):
+        date = '%d +0000' % (BASE + offset)
+        self.git('merge', '-q', '--no-ff', '-m', 'merge', branch,
+                 GIT_COMMITTER_DATE=date, GIT_AUTHOR_DATE=date)
+
+    def assert_matches_git(self, entry):
+        index = DateIndex(self.root)
+        index.repos['repo'] = entry
+        for offset in range(50, 500, 50):
+            expected = self.git('log', '-n', '1', '--format=%H',
+                                '--before=@%d' % (BASE + offset)) or None
+            self.assertEqual(index.find('repo', BASE + offset), expected)
+
+    def test_linear(self):
+        entry = self.repo.get_commit_dates()
+        self.commit(200)
+        self.commit(300)
+        entry = self.repo.get_commit_dates(entry)
+        self.assertTrue(entry['linear'])
+        self.assertEqual(len(entry['commits']), 3)
+        self.assert_matches_git(entry)
+
+    def test_head_moved_back(self):
+        first = self.git('rev-parse', 'HEAD')
+        self.commit(200)
+        entry = self.repo.get_commit_dates()
+        self.git('checkout', '-q', first)
+        entry = self.repo.get_commit_dates(entry)
+        self.assertEqual(entry['commits'], [[BASE + 100, first]])
+        self.assert_matches_git(entry)
+
+    def test_merge_of_older_commits(self):
+        self.git('checkout', '-q', '-b', 'side')
+        self.commit(150)
+        self.git('checkout', '-q', 'main')
+        self.commit(300)
+        entry = self.repo.get_commit_dates()
+        # The merge brings in a commit which is older than the previous tip
+        self.merge('side', 400)
+        entry = self.repo.get_commit_dates(entry)
+        self.assertFalse(entry['linear'])
+        self.assert_matches_git(entry)
+        # Without merges in between the history still has to be rebuilt
+        self.commit(450)
+        self.assert_matches_git(self.repo.get_commit_dates(entry))
+
+    def test_rewritten_history(self):
+        self.commit(200)
+        entry = self.repo.get_commit_dates()
+        self.git('reset', '-q', '--hard', 'HEAD^')
+        self.commit(300)
+        entry = self.repo.get_commit_dates(entry)
+        self.assertEqual(len(entry['commits']), 2)
+        self.assert_matches_git(entry)
+
+    def test_update(self):
+        first = self.git('rev-parse', 'HEAD')
+        self.commit(200)
+        second = self.git('rev-parse', 'HEAD')
+        self.commit(300)
+        date = '@%d' % (BASE + 250)
+        # Without the date index's result git resolves the date
+        self.repo.update(date=date)
+        self.assertEqual(self.git('rev-parse', 'HEAD'), second)
+        self.repo.update(date=date, resolved=first)
+        self.assertEqual(self.git('rev-parse', 'HEAD'), first)
+
+if __name__ == '__main__':
+    unittest.main()
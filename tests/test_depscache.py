@@ -0,0 +1,78 @@
+from dependencymanager import depscache
+from dependencymanager.depscache import read_deps, load_deps_cache, save_deps_cache
+import os
+import shutil
+import tempfile
+import unittest
+
+class DepsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, '.deps')
+        self.cache_file = os.path.join(self.root, 'cache', 'deps-cache.json')
+        depscache.deps_cache.clear()
+        depscache.DEPS_CACHE_FILE = None
+        depscache.deps_cache_changed = False
+        self.parse_deps = depscache.parse_deps
+        self.parsed = []
+        def parse_deps(path):
+            self.parsed.append(path)
+            return self.parse_deps(path)
+        depscache.parse_deps = parse_deps
+
+    def tearDown(self):
+        depscache.parse_deps = self.parse_deps
+        depscache.deps_cache.clear()
+        depscache.DEPS_CACHE_FILE = None
+        shutil.rmtree(self.root)
+
+    def write(self, content, age=10):
+        with open(self.path, 'w') as fp:
+            fp.write(content)
+        # Files which were just modified don't get cached
+        mtime = os.stat(self.path).st_mtime - age
+        os.utime(self.path, (mtime, mtime))
+
+    def test_read_deps(self):
+        self.write('[links]\na = b\n')
+        self.assertEqual(read_deps(self.path), {'links': [('a', 'b')]})
+        self.assertEqual(read_deps(self.path), {'links': [('a', 'b')]})
+        self.assertEqual(len(self.parsed), 1)
+
+    def test_changed_file(self):
+        self.write('[links]\na = b\n')
+        read_deps(self.path)
+        self.write('[links]\na = bc\n', age=5)
+        self.assertEqual(read_deps(self.path), {'links': [('a', 'bc')]})
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_racy_file(self):
+        self.write('[links]\na = b\n', age=0)
+        read_deps(self.path)
+        read_deps(self.path)
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_missing_file(self):
+        self.assertEqual(read_deps(self.path), {})
+        self.write('[links]\na = b\n')
+        self.assertEqual(read_deps(self.path), {'links': [('a', 'b')]})
+
+    def test_persistence(self):
+        load_deps_cache(self.cache_file)
+        self.write('[general]\ndependencies = x y\n')
+        sections = read_deps(self.path)
+        read_deps(os.path.join(self.root, 'missing'))
+        save_deps_cache()
+        self.assertTrue(os.path.exists(self.cache_file))
+
+        depscache.deps_cache.clear()
+        load_deps_cache(self.cache_file)
+        self.assertEqual(list(depscache.deps_cache), [self.path])
+        # json turns the (name, value) tuples into lists
+        general = dict(read_deps(self.path)['general'])
+        self.assertEqual(general, dict(sections['general']))
+        self.assertTrue(isinstance(general['dependencies'], str))
+        self.assertEqual(len(self.parsed), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+from dependencymanager.gitmeta import (GitMetadata, UnsupportedGitFormat,
+    parse_git_value, read_git_config)
+from subprocess import PIPE, Popen
+import os
+import shutil
+import tempfile
+import unittest
+
+SHA1 = '1' * 40
+SHA2 = '2' * 40
+
+def write(path, content):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fp:
+        fp.write(content)
+
+class ParseGitValueTest(unittest.TestCase):
+    def test_comments(self):
+        self.assertEqual(parse_git_value('value # comment'), 'value')
+        self.assertEqual(parse_git_value('value ; comment'), 'value')
+        self.assertEqual(parse_git_value('"a # b"'), 'a # b')
+
+    def test_escapes(self):
+        self.assertEqual(parse_git_value(r'a\tb\\c\"d'), 'a\tb\\c"d')
+        self.assertRaises(UnsupportedGitFormat, parse_git_value, r'a\xb')
+
+class GitConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'config')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read(self, content):
+        write(self.path, content)
+        return read_git_config(self.path)
+
+    def test_sections(self):
+        config = self.read('[Core]\n\tBare = false\n\tfilemode\n'
+                           '[remote "origin"]\n\turl = /some/path # comment\n'
+                           '[branch.Master]\n\tremote = origin\n')
+        self.assertEqual(config[('core', None)], {'bare': 'false', 'filemode': 'true'})
+        self.assertEqual(config[('remote', 'origin')], {'url': '/some/path'})
+        self.assertEqual(config[('branch', 'master')], {'remote': 'origin'})
+
+    def test_subsection_escapes(self):
+        config = self.read('[remote "a\\"b"]\nurl = x\n')
+        self.assertEqual(config[('remote', 'a"b')], {'url': 'x'})
+
+    def test_option_after_section(self):
+        config = self.read('[core] bare = true\n')
+        self.assertEqual(config[('core', None)], {'bare': 'true'})
+
+    def test_continuation(self):
+        # Like git, keep the whitespace around the line break
+        config = self.read('[alias]\n\tx = a \\\n b\n')
+        self.assertEqual(config[('alias', None)], {'x': 'a  b'})
+
+    def test_invalid(self):
+        self.assertRaises(UnsupportedGitFormat, self.read, 'url = x\n')
+        self.assertRaises(UnsupportedGitFormat, self.read, '[core]\n=x\n')
+
+class GitMetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.git_dir = os.path.join(self.root, '.git')
+        write(os.path.join(self.git_dir, 'config'),
+              '[core]\n\trepositoryformatversion = 0\n'
+              '[remote "origin"]\n\turl = https://example.com/repo.git\n')
+        write(os.path.join(self.git_dir, 'HEAD'), 'ref: refs/heads/master\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_remote_url(self):
+        metadata = GitMetadata(self.root)
+        self.assertEqual(metadata.get_remote_url(), 'https://example.com/repo.git')
+        self.assertEqual(metadata.get_remote_url('other'), None)
+
+    def test_loose_and_packed_refs(self):
+        write(os.path.join(self.git_dir, 'packed-refs'),
+              '# pack-refs with: peeled fully-peeled sorted\n'
+              '%s refs/heads/master\n%s refs/tags/v1\n^%s\n' % (SHA1, SHA2, SHA1))
+        write(os.path.join(self.git_dir, 'refs', 'heads', 'feature', 'x'), SHA2 + '\n')
+        write(os.path.join(self.git_dir, 'refs', 'heads', 'master.lock'), SHA2 + '\n')
+        metadata = GitMetadata(self.root)
+        self.assertEqual(metadata.refs('refs/heads/'),
+                         {'refs/heads/master': SHA1, 'refs/heads/feature/x': SHA2})
+        self.assertEqual(metadata.head(), ('master', SHA1))
+
+    def test_loose_ref_overrides_packed_ref(self):
+        write(os.path.join(self.git_dir, 'packed-refs'), '%s refs/heads/master\n' % SHA1)
+        write(os.path.join(self.git_dir, 'refs', 'heads', 'master'), SHA2 + '\n')
+        metadata = GitMetadata(self.root)
+        self.assertEqual(metadata.refs('refs/heads/'), {'refs/heads/master': SHA2})
+        self.assertEqual(metadata.head(), ('master', SHA2))
+
+    def test_unborn_and_detached_head(self):
+        metadata = GitMetadata(self.root)
+        self.assertEqual(metadata.head(), ('master', None))
+        write(os.path.join(self.git_dir, 'HEAD'), SHA1 + '\n')
+        self.assertEqual(metadata.head(), (None, SHA1))
+
+    def test_default_branch(self):
+        metadata = GitMetadata(self.root)
+        self.assertEqual(metadata.default_branch(), None)
+        write(os.path.join(self.git_dir, 'refs', 'remotes', 'origin', 'HEAD'),
+              'ref: refs/remotes/origin/main\n')
+        self.assertEqual(metadata.default_branch(), 'main')
+
+    def test_unsupported_layouts(self):
+        write(os.path.join(self.git_dir, 'commondir'), '../..\n')
+        self.assertRaises(UnsupportedGitFormat, GitMetadata, self.root)
+        os.remove(os.path.join(self.git_dir, 'commondir'))
+        write(os.path.join(self.git_dir, 'config'),
+              '[core]\n\trepositoryformatversion = 1\n'
+              '[extensions]\n\trefStorage = reftable\n')
+        self.assertRaises(UnsupportedGitFormat, GitMetadata, self.root)
+
+    def test_matches_git(self):
+        # Compare against a repository created by git itself, if available
+        repo = os.path.join(self.root, 'real')
+        env = dict(os.environ, GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@t',
+                   GIT_COMMITTER_NAME='t', GIT_COMMITTER_EMAIL='t@t')
+        def git(*args):
+            process = Popen(('git',) + args, cwd=repo, env=env, stdout=PIPE)
+            return process.communicate()[0].decode('ascii').strip()
+        try:
+            os.makedirs(repo)
+            git('init', '-q')
+        except OSError:
+            return
+        git('commit', '-q', '--allow-empty', '-m', 'x')
+        git('checkout', '-q', '-b', 'other')
+        git('pack-refs', '--all')
+        self.assertEqual(GitMetadata(repo).head(), ('other', git('rev-parse', 'HEAD')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+from dependencymanager.hgmeta import (HGMetadata, UnsupportedHGFormat, read_hgrc,
+    get_user_hgrc_paths, is_extension_enabled)
+import os
+import shutil
+import tempfile
+import unittest
+
+NODE1 = '1' * 40
+NODE2 = '2' * 40
+
+def write(path, content):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fp:
+        fp.write(content)
+
+class HGRCTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'hgrc')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read(self, content):
+        write(self.path, content)
+        return read_hgrc(self.path)
+
+    def test_paths(self):
+        config = self.read('# comment\n[paths]\ndefault = https://example.com/%7Euser\n'
+                           'empty =\n; other comment\n')
+        self.assertEqual(config, {'paths': {'default': 'https://example.com/%7Euser',
+                                            'empty': ''}})
+
+    def test_continuation(self):
+        config = self.read('[ui]\nignore = a\n  b\n\n[paths]\n')
+        self.assertEqual(config['ui'], {'ignore': 'a\nb'})
+
+    def test_unset_and_include(self):
+        config = self.read('[paths]\ndefault = x\nother = y\n%unset other\n'
+                           '%include ../other.rc\n')
+        self.assertEqual(config, {'paths': {'default': 'x'}})
+
+    def test_invalid(self):
+        self.assertRaises(UnsupportedHGFormat, self.read, 'default = x\n')
+        self.assertRaises(UnsupportedHGFormat, self.read, '[paths]\ninvalid\n')
+
+    def test_extensions(self):
+        names = ('dmext', 'hgext.dmext')
+        enabled = {'extensions': {'dmext': ''}}
+        disabled = {'extensions': {'hgext.dmext': '!'}}
+        self.assertFalse(is_extension_enabled([{}, {'ui': {}}], names))
+        self.assertTrue(is_extension_enabled([enabled], names))
+        self.assertFalse(is_extension_enabled([enabled, disabled], names))
+        self.assertTrue(is_extension_enabled([disabled, enabled], names))
+
+    def test_hgrcpath(self):
+        environ = os.environ.copy()
+        try:
+            write(os.path.join(self.root, 'rc.d', 'b.rc'), '')
+            write(os.path.join(self.root, 'rc.d', 'a.rc'), '')
+            write(os.path.join(self.root, 'rc.d', 'other'), '')
+            os.environ['HGRCPATH'] = os.pathsep.join(
+                [self.path, os.path.join(self.root, 'rc.d'), self.path + '.missing'])
+            self.read('')
+            self.assertEqual(get_user_hgrc_paths(), [
+                self.path, os.path.join(self.root, 'rc.d', 'a.rc'),
+                os.path.join(self.root, 'rc.d', 'b.rc')])
+            os.environ['HGRCPATH'] = ''
+            self.assertEqual(get_user_hgrc_paths(), [])
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+class HGMetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.hg_dir = os.path.join(self.root, '.hg')
+        write(os.path.join(self.hg_dir, 'requires'), 'revlogv1\nstore\nfncache\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_path(self):
+        metadata = HGMetadata(self.root)
+        self.assertEqual(metadata.get_path(), None)
+        write(os.path.join(self.hg_dir, 'hgrc'), '[paths]\ndefault = /some/path\n')
+        self.assertEqual(metadata.get_path(), '/some/path')
+
+    def test_bookmarks(self):
+        metadata = HGMetadata(self.root)
+        self.assertEqual(metadata.bookmarks(), {})
+        self.assertEqual(metadata.active_bookmark(), None)
+        write(os.path.join(self.hg_dir, 'bookmarks'),
+              '%s @\n%s with space\n' % (NODE1, NODE2))
+        write(os.path.join(self.hg_dir, 'bookmarks.current'), '@')
+        self.assertEqual(metadata.bookmarks(), {'@': NODE1, 'with space': NODE2})
+        self.assertEqual(metadata.active_bookmark(), '@')
+
+    def test_bookmarks_in_store(self):
+        write(os.path.join(self.hg_dir, 'requires'), 'store\nshare-safe\n')
+        write(os.path.join(self.hg_dir, 'store', 'requires'), 'bookmarksinstore\n')
+        write(os.path.join(self.hg_dir, 'store', 'bookmarks'), '%s @\n' % NODE1)
+        self.assertEqual(HGMetadata(self.root).bookmarks(), {'@': NODE1})
+
+    def test_invalid_bookmarks(self):
+        write(os.path.join(self.hg_dir, 'bookmarks'), 'invalid\n')
+        self.assertRaises(UnsupportedHGFormat, HGMetadata(self.root).bookmarks)
+
+    def test_unsupported_repositories(self):
+        write(os.path.join(self.hg_dir, 'requires'), 'store\nsomething-new\n')
+        self.assertRaises(UnsupportedHGFormat, HGMetadata, self.root)
+        write(os.path.join(self.hg_dir, 'requires'), 'store\nshared\n')
+        write(os.path.join(self.hg_dir, 'sharedpath'), '/other/.hg')
+        self.assertRaises(UnsupportedHGFormat, HGMetadata, self.root)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+from dependencymanager.jsonfile import load_json, save_json
+import os
+import shutil
+import tempfile
+import unittest
+
+class JSONFileTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'sub', 'data.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_round_trip(self):
+        self.assertEqual(load_json(self.path, 1), None)
+        save_json(self.path, 1, {'a': [1, 2]})
+        save_json(self.path, 1, {'a': [3]})
+        self.assertEqual(load_json(self.path, 1), {'a': [3], 'version': 1})
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['data.json'])
+
+    def test_other_version(self):
+        save_json(self.path, 1, {'a': 1})
+        self.assertEqual(load_json(self.path, 2), None)
+
+    def test_broken_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        for content in ('{', '[1]'):
+            with open(self.path, 'w') as fp:
+                fp.write(content)
+            self.assertEqual(load_json(self.path, 1), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+from dependencymanager.core import create_links
+import os
+import shutil
+import tempfile
+import unittest
+
+class CreateLinksTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def test_create_and_replace_links(self):
+        os.symlink('old', self.path('a'))
+        self.assertEqual(create_links(self.root, {'a': 'new', 'sub/b': '../b'}), [])
+        self.assertEqual(os.readlink(self.path('a')), 'new')
+        self.assertEqual(os.readlink(self.path('sub/b')), '../b')
+
+    def test_keep_files_and_folders(self):
+        with open(self.path('file'), 'w') as fp:
+            fp.write('important')
+        os.mkdir(self.path('folder'))
+        warnings = create_links(self.root, {'file': 'x', 'folder': 'x', 'link': 'x'})
+        self.assertEqual(len(warnings), 2)
+        with open(self.path('file')) as fp:
+            self.assertEqual(fp.read(), 'important')
+        self.assertTrue(os.path.isdir(self.path('folder')))
+        self.assertFalse(os.path.islink(self.path('folder')))
+        self.assertEqual(os.readlink(self.path('link')), 'x')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+from dependencymanager.manifest import Manifest
+import os
+import shutil
+import tempfile
+import unittest
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, '.repos'))
+        os.makedirs(os.path.join(self.root, 'sub'))
+        self.write('.deps', '[links]\nsub/lib = dep/lib\n')
+        os.symlink('../.repos/dep/lib', os.path.join(self.root, 'sub', 'lib'))
+        self.links = {'sub/lib': 'dep/lib'}
+        self.settings = {'sparse_checkout': False}
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, content):
+        with open(os.path.join(self.root, name), 'w') as fp:
+            fp.write(content)
+
+    def save(self, sparse=()):
+        manifest = Manifest(self.root)
+        manifest.update({}, self.links, self.settings, sparse)
+        manifest.save()
+        return Manifest.load(self.root)
+
+    def touch_later(self, name):
+        # Make sure the mtime changes even with a coarse timestamp resolution
+        path = os.path.join(self.root, name)
+        mtime = os.stat(path).st_mtime + 2
+        os.utime(path, (mtime, mtime))
+
+    def test_empty(self):
+        self.assertFalse(Manifest.load(self.root).is_up_to_date(self.settings))
+
+    def test_round_trip(self):
+        manifest = self.save()
+        self.assertEqual(manifest.links, self.links)
+        self.assertEqual(manifest.settings, self.settings)
+        self.assertTrue(manifest.is_up_to_date(self.settings))
+
+    def test_sparse_repos(self):
+        self.assertEqual(self.save().sparse, [])
+        self.assertEqual(self.save({'b', 'a'}).sparse, ['a', 'b'])
+
+    def test_changed_settings(self):
+        manifest = self.save()
+        self.assertFalse(manifest.is_up_to_date({'sparse_checkout': True}))
+
+    def test_changed_deps(self):
+        manifest = self.save()
+        self.write('.deps', '[links]\n')
+        self.assertFalse(manifest.is_up_to_date(self.settings))
+
+    def test_new_repo(self):
+        manifest = self.save()
+        os.makedirs(os.path.join(self.root, '.repos', 'other'))
+        self.assertFalse(manifest.is_up_to_date(self.settings))
+
+    def test_changed_link(self):
+        manifest = self.save()
+        os.remove(os.path.join(self.root, 'sub', 'lib'))
+        self.assertFalse(manifest.is_up_to_date(self.settings))
+        os.symlink('../.repos/other/lib', os.path.join(self.root, 'sub', 'lib'))
+        self.assertFalse(manifest.is_up_to_date(self.settings))
+
+    def test_stray_link(self):
+        manifest = self.save()
+        os.symlink('../.repos/dep/other', os.path.join(self.root, 'sub', 'other'))
+        self.touch_later('sub')
+        self.assertFalse(manifest.is_up_to_date(self.settings))
+        self.assertEqual(manifest.find_links(), ['sub/lib', 'sub/other'])
+
+    def test_root_links(self):
+        os.symlink('.repos/dep/lib', os.path.join(self.root, 'lib'))
+        self.links = {'lib': 'dep/lib'}
+        manifest = self.save()
+        self.assertEqual(list(manifest.link_dirs), [''])
+        self.assertTrue(manifest.is_up_to_date(self.settings))
+        self.assertEqual(manifest.find_links(), ['lib'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+from dependencymanager.core import get_clone_sparse_paths
+import unittest
+
+class FakeRepo(object):
+    def __init__(self, deps):
+        self.deps = deps
+
+    def get_checkout_file(self, path):
+        assert path == '.deps'
+        return self.deps
+
+class CloneSparsePathsTest(unittest.TestCase):
+    def test_package_and_project_links(self):
+        repo = FakeRepo('[links]\npkg = ./pkg\nother = ./docs\n')
+        paths = get_clone_sparse_paths(repo, 'dep', {'sub/lib': 'dep/lib',
+                                                     'other': 'dep/more',
+                                                     'x': 'else/x'})
+        self.assertEqual(paths, ['.deps', 'lib', 'more', 'pkg'])
+
+    def test_missing_deps(self):
+        self.assertEqual(get_clone_sparse_paths(FakeRepo(None), 'dep', {}), None)
+        paths = get_clone_sparse_paths(FakeRepo(None), 'dep', {'lib': 'dep/lib'})
+        self.assertEqual(paths, ['.deps', 'lib'])
+
+    def test_whole_repo(self):
+        repo = FakeRepo('[links]\npkg = .\n')
+        self.assertEqual(get_clone_sparse_paths(repo, 'dep', {}), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+from dependencymanager import spool
+from dependencymanager.spool import SpooledOutput
+import unittest
+
+class SpooledOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.threshold = spool.SPOOL_THRESHOLD
+        # Make sure the temporary file gets used, too
+        spool.set_spool_threshold(16)
+
+    def tearDown(self):
+        spool.set_spool_threshold(self.threshold)
+
+    def get_value(self, output):
+        return ''.join(output.chunks())
+
+    def test_filter_lines(self):
+        output = SpooledOutput()
+        output.write('keep\r\n')
+        start = output.size
+        output.write('a\r\ndrop\nb\r\n')
+        output.filter_lines(lambda line: None if line == 'drop\n'
+                            else line.replace('\r\n', '\n'), start)
+        self.assertEqual(self.get_value(output), 'keep\r\na\nb\n')
+        self.assertEqual(output.size, len('keep\r\na\nb\n'))
+
+    def test_filter_lines_blank(self):
+        output = SpooledOutput()
+        output.write('drop\n')
+        output.filter_lines(lambda line: None)
+        self.assertFalse(output)
+        self.assertEqual(self.get_value(output), '')
+
+    def test_tail(self):
+        output = SpooledOutput()
+        output.write('first call\n')
+        start = output.size
+        output.write('error\n')
+        self.assertEqual(output.tail(start=start), 'error\n')
+        self.assertEqual(output.tail(size=6, start=0),
+                         '[...output truncated...]\nerror\n')
+
+if __name__ == '__main__':
+    unittest.main()
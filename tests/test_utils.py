@@ -0,0 +1,92 @@
+from dependencymanager.utils import (Executor, CancelledError, as_completed,
+    positive_int)
+from threading import Event, Lock
+import time
+import unittest
+
+class ExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = Executor(jobs=2)
+
+    def tearDown(self):
+        self.executor.shutdown(timeout=5)
+
+    def test_submit(self):
+        tasks = [self.executor.submit(lambda x: x * 2, (i,)) for i in range(5)]
+        self.assertEqual([task.do() for task in tasks], [0, 2, 4, 6, 8])
+
+    def test_jobs_limit(self):
+        self.executor.submit(lambda: None).do()
+        self.executor.submit(lambda: None).do()
+        self.executor.submit(lambda: None).do()
+        self.assertEqual(len(self.executor.workers), 2)
+
+    def test_group_limits(self):
+        executor = Executor(jobs=4, group_limit=1, group_limits={'b': 2})
+        lock = Lock()
+        running = {}
+        maximum = {}
+        release = Event()
+        def run(group):
+            with lock:
+                running[group] = running.get(group, 0) + 1
+                maximum[group] = max(maximum.get(group, 0), running[group])
+            release.wait()
+            with lock:
+                running[group] -= 1
+        try:
+            tasks = [executor.submit(run, (group,), group=group)
+                     for group in ('a', 'a', 'a', 'b', 'b', 'b')]
+            time.sleep(0.2)
+            release.set()
+            for task in tasks:
+                task.do()
+        finally:
+            executor.shutdown(timeout=5)
+        self.assertEqual(maximum, {'a': 1, 'b': 2})
+
+    def test_errors(self):
+        def fail():
+            raise KeyError('error')
+        task = self.executor.submit(fail)
+        self.assertRaises(KeyError, task.do)
+
+    def test_cancel(self):
+        executor = Executor(jobs=1, group_limit=1)
+        release = Event()
+        try:
+            running = executor.submit(release.wait, group='a')
+            queued = executor.submit(lambda: 'queued')
+            pending = executor.submit(lambda: 'pending', group='a')
+            time.sleep(0.1)
+            executor.cancel()
+            self.assertEqual(list(as_completed([queued, pending])), [queued, pending])
+            self.assertRaises(CancelledError, queued.do)
+            self.assertRaises(CancelledError, pending.do)
+            release.set()
+            self.assertTrue(running.do())
+            # The group's slot is free again
+            self.assertEqual(executor.submit(lambda: 'next', group='a').do(), 'next')
+        finally:
+            release.set()
+            executor.shutdown(timeout=5)
+
+    def test_shutdown(self):
+        release = Event()
+        task = self.executor.submit(release.wait)
+        workers = list(self.executor.workers)
+        release.set()
+        task.do()
+        self.executor.shutdown(timeout=5)
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+        self.assertEqual(self.executor.workers, [])
+
+class PositiveIntTest(unittest.TestCase):
+    def test_positive_int(self):
+        self.assertEqual(positive_int('3'), 3)
+        self.assertRaises(ValueError, positive_int, '0')
+        self.assertRaises(ValueError, positive_int, '-1')
+        self.assertRaises(ValueError, positive_int, 'x')
+
+if __name__ == '__main__':
+    unittest.main()